@@ -0,0 +1,114 @@
+"""
+Benchmark the generator pages
+
+Builds a site with a `single` and a `pagination` generator over a data
+source of --rows items, in a temporary directory, and times build_pages().
+
+    python benchmarks/generators.py --rows 50000
+
+Run it from a checkout of the version to measure, ie: before and after a
+change, to compare the timings.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from yass.yass import Yass
+
+CONFIG = """
+sitename: bench.example.com
+default_layout: layouts/default.html
+static_url: /static
+cache: False
+workers: 1
+site:
+  base_url: /
+"""
+
+LAYOUT = """<html>
+<head><title>{{ page.title }}</title></head>
+<body>{% block body %}{% endblock %}</body>
+</html>
+"""
+
+SINGLE = """---
+title: Post
+_generator:
+  type: single
+  data_source: posts
+  slug: /post/{id}
+---
+{% block body %}
+<h1>{{ page.context.name }}</h1>
+<p>{{ page.context.body }}</p>
+{% endblock %}
+"""
+
+PAGINATION = """---
+title: Posts
+_generator:
+  type: pagination
+  data_source: posts
+  per_page: 20
+  slug: /posts/page/{page_num}
+  index_slug: /posts
+---
+{% block body %}
+<ul>
+{% for post in page.context %}<li>{{ post.name }}</li>{% endfor %}
+</ul>
+{% endblock %}
+"""
+
+
+def write(root, filepath, content):
+    filepath = os.path.join(root, filepath)
+    if not os.path.isdir(os.path.dirname(filepath)):
+        os.makedirs(os.path.dirname(filepath))
+    with open(filepath, "w") as f:
+        f.write(content)
+
+
+def create_site(root, rows):
+    write(root, "yass.yml", CONFIG)
+    write(root, "templates/layouts/default.html", LAYOUT)
+    write(root, "pages/post.html", SINGLE)
+    write(root, "pages/posts.html", PAGINATION)
+    write(root, "data/posts.json", json.dumps([
+        {"id": i, "name": "Post %s" % i, "body": "Lorem ipsum dolor sit amet " * 10}
+        for i in range(rows)]))
+    os.makedirs(os.path.join(root, "static"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the generator pages")
+    parser.add_argument("--rows", type=int, default=50000,
+                        help="Number of items in the data source")
+    parser.add_argument("--runs", type=int, default=1,
+                        help="Number of builds, the best one is reported")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="yass-bench-")
+    try:
+        create_site(root, args.rows)
+        timings = []
+        for _ in range(args.runs):
+            yass = Yass(root)
+            start = time.time()
+            yass.build_pages()
+            timings.append(time.time() - start)
+            shutil.rmtree(yass.build_dir)
+        pages = args.rows + (args.rows + 19) // 20 + 1
+        print("%s rows, %s pages: %.1fs" % (args.rows, pages, min(timings)))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
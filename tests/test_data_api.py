@@ -0,0 +1,160 @@
+"""
+The data api urls, fetched from a local stand-in HTTP server
+
+    python -m unittest discover tests
+"""
+import os
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from yass.yass import Yass
+
+
+class APIHandler(BaseHTTPRequestHandler):
+    """ Serve the json of `data`, with an ETag, and 404 for the other paths """
+    data = {}
+    requests = []
+
+    def do_GET(self):
+        name = self.path.strip("/")
+        etag = '"%s"' % name
+        self.requests.append((name, self.headers.get("If-None-Match")))
+        if name not in self.data:
+            self.send_response(404)
+            self.end_headers()
+        elif self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+        else:
+            body = json.dumps(self.data[name]).encode("utf-8")
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+CONFIG = """
+sitename: test.example.com
+default_layout: layouts/default.html
+data_api_cache_ttl: %(ttl)s
+site:
+  base_url: /
+  data_api_urls:
+    posts: %(url)s/posts
+    authors: %(url)s/authors
+    missing: %(url)s/missing
+"""
+
+
+class DataAPITest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(("127.0.0.1", 0), APIHandler)
+        cls.url = "http://127.0.0.1:%s" % cls.server.server_port
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        APIHandler.data = {
+            "posts": [{"id": 1, "title": "Post 1"}, {"id": 2, "title": "Post 2"}],
+            "authors": {"name": "Yass"}
+        }
+        APIHandler.requests = []
+        self.root = tempfile.mkdtemp(prefix="yass-test-")
+        self.write("templates/layouts/default.html",
+                   "<html>{% block body %}{% endblock %}</html>")
+        self.write("pages/index.html",
+                   "{% block body %}{{ data.posts | length }}{% endblock %}")
+        self.write("pages/about.html",
+                   "{% block body %}{{ data.authors.name }}{% endblock %}")
+        for d in ["static", "data"]:
+            os.makedirs(os.path.join(self.root, d))
+        self.set_config()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, filepath, content):
+        filepath = os.path.join(self.root, filepath)
+        if not os.path.isdir(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+        with open(filepath, "w") as f:
+            f.write(content)
+
+    def set_config(self, ttl=0):
+        self.write("yass.yml", CONFIG % {"url": self.url, "ttl": ttl})
+
+    def read(self, filepath):
+        with open(os.path.join(self.root, "build", filepath)) as f:
+            return f.read()
+
+    def requested(self):
+        return sorted([name for name, _ in APIHandler.requests])
+
+    def test_only_the_data_used_is_fetched(self):
+        yass = Yass(self.root)
+        self.assertEqual(yass._data["posts"][1]["title"], "Post 2")
+        self.assertEqual(self.requested(), ["posts"])
+
+    def test_cached_response_is_revalidated(self):
+        Yass(self.root)._data["posts"]
+        APIHandler.requests = []
+        self.assertEqual(len(Yass(self.root)._data["posts"]), 2)
+        self.assertEqual(APIHandler.requests, [("posts", '"posts"')])
+
+    def test_cached_response_is_used_within_ttl(self):
+        self.set_config(ttl=3600)
+        Yass(self.root)._data["posts"]
+        APIHandler.requests = []
+        self.assertEqual(len(Yass(self.root)._data["posts"]), 2)
+        self.assertEqual(APIHandler.requests, [])
+
+    def test_offline_uses_the_cached_responses(self):
+        Yass(self.root)._data["posts"]
+        APIHandler.requests = []
+        yass = Yass(self.root, {"data_api_offline": True})
+        self.assertEqual(len(yass._data["posts"]), 2)
+        self.assertRaises(Exception, lambda: yass._data["authors"])
+        self.assertEqual(APIHandler.requests, [])
+
+    def test_failing_url_only_fails_its_data(self):
+        yass = Yass(self.root)
+        yass.prefetch_data_api()
+        self.assertRaises(Exception, lambda: yass._data["missing"])
+        self.assertEqual(yass._data["authors"]["name"], "Yass")
+        yass.build()
+        self.assertIn("2", self.read("index.html"))
+        self.assertEqual(self.requested(), ["authors", "missing", "posts"])
+
+    def test_parallel_build_fetches_each_url_once(self):
+        for i in range(6):
+            self.write("pages/post-%s.html" % i,
+                       "{% block body %}{{ data.posts[0].title }}{% endblock %}")
+        Yass(self.root).build(jobs=3)
+        self.assertIn("Post 1", self.read("post-3/index.html"))
+        self.assertIn("Yass", self.read("about/index.html"))
+        self.assertEqual(self.requested(), ["authors", "missing", "posts"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+"""
+`yass publish` against a local S3 stand-in: a moto server, either the one of
+YASS_TEST_S3_ENDPOINT, ie: http://localhost:5000, or one started in-process
+
+    python -m unittest discover tests
+"""
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+import uuid
+
+import boto3
+from click.testing import CliRunner
+
+from yass import cli, publisher
+from yass.yass import Yass
+
+CONFIG = """
+sitename: %(sitename)s
+default_layout: layouts/default.html
+site:
+  base_url: /
+hosting:
+  s3:
+    endpoint_url: %(endpoint)s
+    aws_access_key_id: testing
+    aws_secret_access_key: testing
+    aws_region: us-east-1
+    upload_retries: 0
+"""
+
+
+def start_s3_server():
+    """ Return the url of the S3 stand-in, None if there's none """
+    if os.environ.get("YASS_TEST_S3_ENDPOINT"):
+        return os.environ["YASS_TEST_S3_ENDPOINT"]
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        return None
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False).start()
+    return "http://127.0.0.1:%s" % port
+
+
+class PublishTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.endpoint = start_s3_server()
+        if not cls.endpoint:
+            raise unittest.SkipTest("moto is not installed")
+        cls.s3 = boto3.client("s3",
+                              endpoint_url=cls.endpoint,
+                              aws_access_key_id="testing",
+                              aws_secret_access_key="testing",
+                              region_name="us-east-1")
+
+    def setUp(self):
+        self.sitename = "yass-%s.test" % uuid.uuid4().hex[:12]
+        self.s3.create_bucket(Bucket=self.sitename)
+        self.s3.put_bucket_website(Bucket=self.sitename, WebsiteConfiguration={
+            "IndexDocument": {"Suffix": "index.html"}})
+
+        self.root = tempfile.mkdtemp(prefix="yass-test-")
+        self.write("yass.yml", CONFIG % {"sitename": self.sitename,
+                                         "endpoint": self.endpoint})
+        self.write("templates/layouts/default.html",
+                   "<html>{% block body %}{% endblock %}</html>")
+        self.write("pages/index.html", "{% block body %}Home{% endblock %}")
+        self.write("pages/about.html", "{% block body %}About{% endblock %}")
+        self.write("static/style.css", "body {}")
+        os.makedirs(os.path.join(self.root, "data"))
+        Yass(self.root).build()
+
+        self._cwd = cli.CWD
+        cli.CWD = self.root
+        self._put_file = publisher.S3Website.__dict__["_put_file"]
+
+    def tearDown(self):
+        cli.CWD = self._cwd
+        publisher.S3Website._put_file = self._put_file
+        shutil.rmtree(self.root)
+
+    def write(self, filepath, content):
+        filepath = os.path.join(self.root, filepath)
+        if not os.path.isdir(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+        with open(filepath, "w") as f:
+            f.write(content)
+
+    def publish(self):
+        return CliRunner().invoke(cli.cli, ["publish"])
+
+    def keys(self):
+        objects = self.s3.list_objects_v2(Bucket=self.sitename).get("Contents", [])
+        return sorted([o["Key"] for o in objects if not o["Key"].startswith(".")])
+
+    def test_publish(self):
+        result = self.publish()
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("successfully published", result.output)
+        self.assertEqual(self.keys(), ["about/index.html", "index.html",
+                                       "static/style.css"])
+
+        result = self.publish()
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("0 uploaded, 0 headers refreshed, 3 unchanged", result.output)
+
+    def test_failed_upload_exits_with_an_error(self):
+        def put_file(s3website, item):
+            if item[1] == "about/index.html":
+                raise IOError("Connection reset")
+            return self._put_file(s3website, item)
+        publisher.S3Website._put_file = put_file
+
+        result = self.publish()
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("1 file(s) failed to upload", result.output)
+        self.assertIn("about/index.html: Connection reset", result.output)
+        self.assertNotIn("successfully published", result.output)
+        self.assertEqual(self.keys(), ["index.html", "static/style.css"])
+
+        # The file failed is uploaded on the next publish
+        publisher.S3Website._put_file = self._put_file
+        result = self.publish()
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("1 uploaded, 0 headers refreshed, 2 unchanged", result.output)
+        self.assertIn("about/index.html", self.keys())
+
+
+if __name__ == "__main__":
+    unittest.main()
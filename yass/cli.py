@@ -2,10 +2,11 @@
 import os
 import sys
 import time
+import mimetypes
 import click
 import pkg_resources
 from livereload import Server, shell
-from . import Yass, publisher
+from . import Yass, publisher, utils
 from .yass import PAGE_FORMAT
 from .__about__ import *
 
@@ -117,10 +118,27 @@ def version():
     footer()
 
 @cli.command("build")
-def build():
+@click.option("--incremental", is_flag=True)
+@click.option("-j", "--jobs", type=int, default=None,
+              help="Number of processes to render the pages with")
+@click.option("--offline", is_flag=True,
+              help="Use the cached responses of the data api urls")
+def build(incremental, jobs, offline):
     """Build everything"""
     print("Building pages...")
-    Yass(CWD).build()
+    config = {"data_api_offline": True} if offline else None
+    yass = Yass(CWD, config)
+    yass.build(incremental=incremental, jobs=jobs)
+    report = yass.minify_report
+    if report and report["files"]:
+        saved = report["size"] - report["minified_size"]
+        print("HTML minified: %s files of %s pages, %s -> %s bytes (-%.1f%%) in %.3fs"
+              % (report["files"], report["pages"], report["size"],
+                 report["minified_size"], 100.0 * saved / max(1, report["size"]),
+                 report["time"]))
+        print("Slowest files to minify:")
+        for output, seconds in report["slowest"]:
+            print("  %s: %.1fms" % (output, seconds * 1000))
     print("Done!")
 
     footer()
@@ -131,7 +149,8 @@ def build():
 @click.option("--purge-files", is_flag=True)
 @click.option("--rebuild-manifest", is_flag=True)
 @click.option("--skip-upload", is_flag=True)
-def publish(endpoint, purge_files, rebuild_manifest, skip_upload):
+@click.option("--refresh-headers", is_flag=True)
+def publish(endpoint, purge_files, rebuild_manifest, skip_upload, refresh_headers):
     """Publish the site"""
     print("Publishing site to %s ..." % endpoint.upper())
 
@@ -150,7 +169,14 @@ def publish(endpoint, purge_files, rebuild_manifest, skip_upload):
         p = publisher.S3Website(sitename=sitename,
                                 aws_access_key_id=endpoint.get("aws_access_key_id"),
                                 aws_secret_access_key=endpoint.get("aws_secret_access_key"),
-                                region=endpoint.get("aws_region"))
+                                region=endpoint.get("aws_region"),
+                                endpoint_url=endpoint.get("endpoint_url"),
+                                upload_workers=endpoint.get("upload_workers", 10),
+                                upload_retries=endpoint.get("upload_retries", 3),
+                                multipart_threshold=endpoint.get("multipart_threshold", 16),
+                                multipart_chunksize=endpoint.get("multipart_chunksize", 8),
+                                gzip=endpoint.get("gzip", False),
+                                cache_rules=endpoint.get("cache_rules"))
 
         if not p.website_exists:
             print(">>>")
@@ -165,22 +191,63 @@ def publish(endpoint, purge_files, rebuild_manifest, skip_upload):
         if rebuild_manifest:
             print(">>>")
             print("Rebuilding site's manifest...")
-            p.create_manifest_from_s3_files()
+            print("%s files found" % p.create_manifest_from_s3_files())
+
+        purge = purge_files is True or endpoint.get("purge_files") is True
+        exclude_files = endpoint.get("purge_exclude_files", [])
+        failed = False
+
+        def progress(done, total, s3_path, error):
+            sys.stdout.write("\r%s/%s files" % (done, total))
+            if done == total:
+                sys.stdout.write("\n")
+            sys.stdout.flush()
 
-        if purge_files is True or endpoint.get("purge_files") is True:
+        if refresh_headers:
             print(">>>")
-            print("Purging files...")
-            exclude_files = endpoint.get("purge_exclude_files", [])
-            p.purge_files(exclude_files=exclude_files)
+            print("Refreshing the headers of the files...")
+            # The files are copied onto themselves, with their new headers
+            result = p.refresh_headers(yass.build_dir, progress=progress)
+            print("%s refreshed, %s changed since the last upload" % (len(result["refreshed"]),
+                                                                      len(result["skipped"])))
+            if result["failed"]:
+                failed = True
+                error("%s file(s) failed to refresh:" % len(result["failed"]))
+                for s3_path, e in sorted(result["failed"]):
+                    print("  %s: %s" % (s3_path, e))
 
         if not skip_upload:
             print(">>>")
             print("Uploading your site...")
-            p.upload(yass.build_dir)
+
+            # Only the files changed are uploaded, then the files removed
+            # from the site are deleted, if purging
+            result = p.upload(yass.build_dir,
+                              purge=purge,
+                              exclude_files=exclude_files,
+                              progress=progress)
+            print("%s uploaded, %s headers refreshed, %s unchanged, %s deleted"
+                  % (len(result["uploaded"]), len(result["refreshed"]),
+                     len(result["skipped"]), len(result["deleted"])))
+            if result["failed"]:
+                failed = True
+                error("%s file(s) failed to upload:" % len(result["failed"]))
+                for s3_path, e in sorted(result["failed"]):
+                    print("  %s: %s" % (s3_path, e))
         else:
+            if purge:
+                print(">>>")
+                print("Purging files...")
+                p.purge_files(exclude_files=exclude_files)
             print(">>>")
             print("WARNING: files upload was skipped because of the use of --skip-upload")
 
+        # The files failed are retried on the next publish
+        if failed:
+            print("")
+            print("The site was not fully published, run publish again to retry")
+            sys.exit(1)
+
         print("")
         print("Yass! Your site has been successfully published to: ")
         print(p.website_endpoint_url)
@@ -307,7 +374,9 @@ def create_page(pagename):
 @click.option("-p", "--port", default=None)
 @click.option("--no-livereload", default=None)
 @click.option("--open-url", default=None)
-def serve(port, no_livereload, open_url):
+@click.option("--lazy", is_flag=True, default=None,
+              help="Render the pages on request, without building the site first")
+def serve(port, no_livereload, open_url, lazy):
     """Serve the site """
 
     engine = Yass(CWD)
@@ -318,25 +387,74 @@ def serve(port, no_livereload, open_url):
     if open_url is None:
         open_url = False if engine.config.get("local_server.open_url") is False else True
 
+    if lazy is None:
+        lazy = engine.config.get("local_server.lazy") is True
+
     print("Serving at %s" % port)
     print("Livereload is %s" % ("OFF" if no_livereload else "ON"))
+    print("Pages are rendered %s" % ("on request" if lazy else "on build"))
 
-    def build_static():
+    if lazy:
         engine.build_static()
-
-    def build_pages():
-        engine.build_pages()
-
-    engine.build()
-
-    server = Server()
+        engine.scan_pages()
+    else:
+        engine.build()
+
+    # The watcher only tells that something changed in a directory.
+    # Each directory is compared to its last snapshot to get all the files
+    # changed, added or deleted, so only what they affect is built again
+    snapshots = {}
+
+    def snapshot(directory):
+        snapshots[directory] = utils.get_mtimes(directory)
+
+    def rebuild(directory):
+        def _rebuild():
+            previous = snapshots.get(directory, {})
+            snapshot(directory)
+            current = snapshots[directory]
+            paths = [p for p in set(previous) | set(current)
+                     if previous.get(p) != current.get(p)]
+            if paths:
+                start = time.time()
+                try:
+                    if lazy:
+                        pages = engine.invalidate(paths)
+                        print("Invalidated %s page(s)" % len(pages))
+                    else:
+                        pages = engine.rebuild(paths)
+                        print("Rebuilt %s page(s) in %.2fs" % (len(pages),
+                                                               time.time() - start))
+                except Exception as e:
+                    error("Build failed: %s" % e)
+        return _rebuild
+
+    def app(environ, start_response):
+        """ Render the page of the url requested, see Yass.render_url() """
+        try:
+            filepath = engine.render_url(environ.get("PATH_INFO", "/"))
+        except Exception as e:
+            start_response("500 Internal Server Error",
+                           [("Content-Type", "text/plain")])
+            return [("Build failed: %s" % e).encode("utf-8")]
+        if not filepath:
+            start_response("404 Not Found", [("Content-Type", "text/plain")])
+            return [b"Not Found"]
+        mimetype = mimetypes.guess_type(filepath)[0] or "application/octet-stream"
+        with open(filepath, "rb") as f:
+            body = f.read()
+        start_response("200 OK", [("Content-Type", mimetype)])
+        return [body]
+
+    server = Server(app if lazy else None)
     if no_livereload is False:
-        server.watch(engine.static_dir + "/", build_static)
-        server.watch(engine.pages_dir + "/", build_pages)
-        server.watch(engine.templates_dir + "/", build_pages)
-        server.watch(engine.data_dir + "/", build_pages)
+        for directory in [engine.static_dir, engine.pages_dir,
+                          engine.templates_dir, engine.data_dir]:
+            snapshot(directory)
+            server.watch(directory + "/", rebuild(directory))
 
-    server.serve(open_url_delay=open_url, port=port, root=engine.build_dir)
+    server.serve(open_url_delay=open_url, port=port, root=engine.build_dir,
+                 debug=False)
 
 
 @cli.command("clean")
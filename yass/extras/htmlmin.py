@@ -0,0 +1,72 @@
+"""
+  -- htmlmin
+
+    Minify the HTML of a rendered page, in a single pass over it.
+
+    Unlike the HTMLCompress extension, which only sees the data of the
+    templates at compile time, it works on the final output, so the
+    whitespace of the variables, Markdown and Jade content is minified too.
+
+    - The runs of whitespace are collapsed to a single space
+    - The whitespace next to block elements is removed
+    - The comments are removed, except the conditional comments
+    - pre, textarea, script, style and noscript are left as is
+
+      html = minify(html)
+
+"""
+import re
+from .htmlcompress import HTMLCompress
+
+isolated_elements = HTMLCompress.isolated_elements
+block_elements = HTMLCompress.block_elements | set([
+    'html', 'head', 'body', 'title', 'meta', 'link', 'base', 'br', 'hr',
+    'section', 'article', 'header', 'footer', 'nav', 'main', 'aside',
+    'figure', 'figcaption', 'fieldset', 'legend', 'caption', 'colgroup',
+    'option', 'optgroup', 'select', 'address', 'details', 'summary', 'pre',
+    'style'])
+
+# The markup, the text between is minified:
+# comments, isolated elements with their content, and tags
+gl_token_re = re.compile(r'''
+    (?P<comment><!--.*?-->)
+  | (?P<isolated><(?P<itag>%s)\b(?:[^>"']|"[^"]*"|'[^']*')*>.*?</(?P=itag)\s*>)
+  | (?P<tag></?(?P<tag_name>[a-zA-Z][a-zA-Z0-9_-]*)(?:[^>"']|"[^"]*"|'[^']*')*>)
+''' % "|".join(isolated_elements), re.S | re.I | re.X)
+gl_ws_normalize_re = re.compile(r'[ \t\r\n\f]+')
+
+
+def _minify_text(text, after_block, before_block):
+    text = gl_ws_normalize_re.sub(' ', text)
+    if after_block:
+        text = text.lstrip(' ')
+    if before_block:
+        text = text.rstrip(' ')
+    return text
+
+
+def minify(html):
+    """
+    Minify HTML
+    :param html: string
+    :return: string
+    """
+    buffer = []
+    text = []
+    after_block = True
+    pos = 0
+    for match in gl_token_re.finditer(html):
+        text.append(html[pos:match.start()])
+        pos = match.end()
+        markup = match.group()
+        if match.group('comment') and not markup.startswith(('<!--[if', '<!--<![')):
+            continue
+        tag = (match.group('tag_name') or match.group('itag') or '').lower()
+        is_block = tag in block_elements
+        buffer.append(_minify_text(''.join(text), after_block, is_block))
+        buffer.append(markup)
+        text = []
+        after_block = is_block
+    text.append(html[pos:])
+    buffer.append(_minify_text(''.join(text), after_block, True))
+    return ''.join(buffer)
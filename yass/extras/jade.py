@@ -8,8 +8,11 @@ A jade extension that embed jade markup in the .html file
 
 """
 
+import os
 import re
+import hashlib
 import pyjade
+import pyjade.ext.jinja
 from jinja2.ext import Extension
 from pyjade.utils import process
 from pyjade.ext.jinja import Compiler
@@ -23,8 +26,44 @@ begin_tag_m = re.compile(begin_tag_rx)
 end_tag_m = re.compile(end_tag_rx)
 
 
-def convert(text, filename=None):
-    return process(text, filename=filename, compiler=Compiler)
+def convert(text, filename=None, cache=None, **options):
+    """
+    Convert Jade text to Jinja
+    :param text:
+    :param filename:
+    :param cache: An object with get(key) and set(key, value),
+                  ie: yass.utils.FileCache. The result is cached by the hash
+                  of the text and the options, so PyJade only runs on changes
+    :param options: the Jinja compiler options
+    :return: string
+    """
+    key = None
+    if cache:
+        _text = text if isinstance(text, bytes) else text.encode("utf-8")
+        key = "jade:%s:%s" % (hashlib.md5(_text).hexdigest(),
+                              hashlib.md5(repr(sorted(options.items())).encode("utf-8")).hexdigest())
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    jinja_source = process(text, filename=filename, compiler=Compiler, **options)
+    if cache:
+        cache.set(key, jinja_source)
+    return jinja_source
+
+
+class PyJadeExtension(pyjade.ext.jinja.PyJadeExtension):
+    """
+    Load .jade templates, using the `jade_cache` of the environment if any
+    """
+
+    def preprocess(self, source, name, filename=None):
+        if (not name or
+           (name and not os.path.splitext(name)[1] in self.file_extensions)):
+            return source
+        return convert(source, filename=name,
+                       cache=getattr(self.environment, "jade_cache", None),
+                       **self.options)
 
 class TemplateIndentationError(TemplateSyntaxError): pass
 
@@ -51,7 +90,8 @@ class JadeTagExtension(Extension):
                                               self._get_lineno(source[:start_pos]))
 
                 jade_source = source[tag_match.end(): end_tag.start()]
-                jade_source = convert(jade_source)
+                jade_source = convert(jade_source,
+                                      cache=getattr(self.environment, "jade_cache", None))
 
                 try:
                     ret_source += source[start_pos: tag_match.start()] + jade_source
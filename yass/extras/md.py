@@ -8,6 +8,7 @@ extract_images: Return a list of images, can be used to extract the top image
 """
 
 import os
+import hashlib
 import markdown
 from markdown.treeprocessors import Treeprocessor
 from markdown.extensions import Extension
@@ -178,12 +179,13 @@ class MarkdownExtension(JExtension):
 
 
 # Markdown
-mkd = markdown.Markdown(extensions=[
+EXTENSIONS = [
     'markdown.extensions.nl2br',
     'markdown.extensions.sane_lists',
     'markdown.extensions.toc',
     'markdown.extensions.tables'
-])
+]
+mkd = markdown.Markdown(extensions=EXTENSIONS)
 
 
 def convert(text):
@@ -207,3 +209,28 @@ def get_toc(text):
     toc = mkd.toc
     mkd.reset()
     return toc
+
+
+def convert_with_toc(text, cache=None):
+    """
+    Convert MD text to HTML and extract its Table of Content in one pass
+    :param text:
+    :param cache: An object with get(key) and set(key, value),
+                  ie: yass.utils.FileCache. The result is cached by the hash
+                  of the text and the extensions.
+    :return: tuple(html, toc)
+    """
+    key = None
+    if cache:
+        _text = text if isinstance(text, bytes) else text.encode("utf-8")
+        key = "md:%s:%s" % (",".join(EXTENSIONS), hashlib.md5(_text).hexdigest())
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    html = mkd.convert(text)
+    toc = mkd.toc
+    mkd.reset()
+    if cache:
+        cache.set(key, (html, toc))
+    return html, toc
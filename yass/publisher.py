@@ -1,14 +1,32 @@
 
 import botocore
+import botocore.config
+import botocore.utils
 import boto3
+import io
 import json
+import hashlib
 import os
-import threading
-import uuid
+import re
+import shutil
 import tempfile
+import time
+import datetime
+import uuid
+import gzip
+import zlib
+import multiprocessing.pool
 from . import utils
 
 
+MB = 1024 * 1024
+
+# The errors of S3 operations that are retried
+RETRY_ERRORS = (botocore.exceptions.BotoCoreError,
+                botocore.exceptions.ClientError,
+                IOError, OSError)
+
+
 class S3Website(object):
     """
     To manage S3 website and domain on Route53
@@ -29,30 +47,76 @@ class S3Website(object):
     }
 
     manifest_file = ".yass-manifest"
+    manifest_version = 3
 
     def __init__(self,
                  sitename,
                  region="us-east-1",
                  aws_access_key_id=None,
-                 aws_secret_access_key=None):
+                 aws_secret_access_key=None,
+                 endpoint_url=None,
+                 upload_workers=10,
+                 upload_retries=3,
+                 multipart_threshold=16,
+                 multipart_chunksize=8,
+                 gzip=False,
+                 cache_rules=None):
         """
 
         :param sitename: the website name to create, without WWW.
         :param region: the region of the site
         :param access_key_id: AWS
         :param secret_access_key: AWS
+        :param endpoint_url: the S3 endpoint, ie: to use a local S3 server
+        :param upload_workers: int - the number of files to upload at once
+        :param upload_retries: int - the number of times to retry a failed upload
+        :param multipart_threshold: int - the size in MB from which the files
+                                    are uploaded in parts
+        :param multipart_chunksize: int - the size in MB of the parts, 5 at least
+        :param gzip: bool - To upload the text files gzipped, with their
+                     `Content-Encoding`
+        :param cache_rules: list of dict - the headers of the files matching a
+                            glob: `match`, `cache_control`, `expires` (seconds
+                            or a date) and `metadata`. The first rule that
+                            matches a file is used
         :param setup_dns: bool - If True it will create route53
         :param allow_www: Bool - If true, it will create a second bucket with www.
         """
 
-        # This will be used to pass to concurrent upload
         self.aws_params = {
             "aws_access_key_id": aws_access_key_id,
             "aws_secret_access_key": aws_secret_access_key,
             "region_name": region
         }
         self.region = region
-        self.s3 = boto3.client('s3', **self.aws_params)
+        self.upload_workers = max(1, int(upload_workers or 1))
+        self.upload_retries = int(upload_retries or 0)
+        self.multipart_threshold = int(float(multipart_threshold or 16) * MB)
+        self.multipart_chunksize = max(5 * MB, int(float(multipart_chunksize or 8) * MB))
+        self.gzip = gzip
+        self.cache_rules = []
+        # The globs are matched at once, each rule being a named group
+        self._cache_rules_re = []
+        for i, rule in enumerate(cache_rules or []):
+            globs = rule.get("match") or []
+            if not isinstance(globs, list):
+                globs = [globs]
+            headers = dict([(k, v) for k, v in rule.items() if k != "match"])
+            if "expires" in headers:
+                headers["expires"] = self._parse_expires(headers["expires"])
+            digest = hashlib.md5(json.dumps(headers, sort_keys=True,
+                                            default=str).encode("utf-8"))
+            self.cache_rules.append((headers, digest.hexdigest()[:12]))
+            # Python 2 supports 100 named groups per regex
+            if i % 90 == 0:
+                self._cache_rules_re.append([])
+            self._cache_rules_re[-1].append("(?P<r%s>(?:%s))$" % (
+                i, "|".join([utils.glob_to_regex(g) for g in globs]) or "(?!)"))
+        self._cache_rules_re = [re.compile("|".join(r)) for r in self._cache_rules_re]
+        # The client is shared by the upload threads, with a connection each
+        config = botocore.config.Config(max_pool_connections=self.upload_workers)
+        self.s3 = boto3.client('s3', endpoint_url=endpoint_url, config=config,
+                               **self.aws_params)
         self.sitename = sitename
         self.www_sitename = "www." + self.sitename
         self.website_endpoint = "%s.s3-website-%s.amazonaws.com" % (self.sitename, region)
@@ -193,33 +257,135 @@ class S3Website(object):
                                 "Error: %s" % (self.www_sitename, error_message))
         return False
 
-    def upload(self, build_dir):
+    def upload(self, build_dir, purge=False, exclude_files=None, progress=None):
         """
+        Upload the files of the build dir that changed since the last upload,
+        with a pool of threads sharing the same client. The content hash of
+        each file is compared to the one in the manifest, to skip the files
+        that didn't change. The files whose cache rule changed only get their
+        headers set, by copying them onto themselves.
+        The manifest is saved once all the uploads are done.
 
         :param build_dir: The directory to upload
-        :param save_manifest: bool: To save manifest file
-        :param purge: bool : To delete previously uploaded files
-        :return:
+        :param purge: bool - To delete the files that are not in the build dir
+                      anymore, once the other files are uploaded
+        :param exclude_files: list - files not to delete
+        :param progress: callable(done, total, s3_path, error) - called after
+                         each file is uploaded, skipped or failed
+        :return: dict of the `uploaded`, `refreshed`, `skipped` and `deleted`
+                 files, and the list of tuple(s3_path, error) of the files
+                 that `failed`
         """
-        files_list = []
-        for root, dirs, files in os.walk(build_dir):
-            for filename in files:
-                local_path = os.path.join(root, filename)
-                s3_path = os.path.relpath(local_path, build_dir)
-                mimetype = utils.get_mimetype(local_path)
+        manifest = self._get_manifest_data()
+        # The files gzipped for the upload are written there, not in the build dir
+        tmp_dir = tempfile.mkdtemp(prefix="yass-upload-") if self.gzip else None
+        try:
+            return self._upload_files(self._get_files(build_dir, manifest, tmp_dir),
+                                      manifest, purge, exclude_files, progress)
+        finally:
+            if tmp_dir:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
 
-                kwargs = dict(aws_params=self.aws_params,
-                              bucket_name=self.sitename,
-                              local_path=local_path,
-                              s3_path=s3_path,
-                              mimetype=mimetype)
+    def _upload_files(self, files_list, manifest, purge, exclude_files, progress):
+        """
+        Upload the files that changed, see upload()
+        :param files_list: list of tuple(local_path, s3_path, mimetype, manifest entry)
+        :param manifest: dict - the files in the manifest
+        """
+        result = {"uploaded": [], "refreshed": [], "skipped": [],
+                  "deleted": [], "failed": []}
+        new_manifest = {}
+        # The number of files done, whatever their status
+        finished = [0]
 
-                files_list.append(s3_path)
-                threading.Thread(target=self._upload_file, kwargs=kwargs)\
-                    .start()
+        def done(s3_path, entry, status, error=None):
+            finished[0] += 1
+            if error:
+                result["failed"].append((s3_path, error))
+                # The previous version, if any, is still there
+                if manifest.get(s3_path):
+                    new_manifest[s3_path] = manifest[s3_path]
+            else:
+                result[status].append(s3_path)
+                new_manifest[s3_path] = entry
+            if progress:
+                progress(finished[0], len(files_list), s3_path, error)
+
+        pool = multiprocessing.pool.ThreadPool(self.upload_workers)
+        try:
+            # The files are hashed, to find the ones that changed
+            small_files = []
+            large_files = []
+            copies = []
+            for item, entry, error in pool.imap_unordered(self._check_file, files_list):
+                old_entry = item[3]
+                if error:
+                    done(item[1], None, "skipped", error)
+                elif old_entry and old_entry[0] == entry[0] \
+                        and old_entry[2] in (None, entry[2]):
+                    if (old_entry[3:] or [None])[0] == entry[3] \
+                            and not self._is_expiring(item[1], old_entry):
+                        # The headers were set at the previous upload
+                        done(item[1], entry[:4] + old_entry[4:5], "skipped")
+                    else:
+                        copies.append(("copy", item, entry))
+                elif entry[1] >= self.multipart_threshold:
+                    large_files.append((item, entry))
+                else:
+                    small_files.append((item, entry))
+
+            # The large files are uploaded in parts, resuming their previous
+            # upload if it was interrupted. The parts and the small files share
+            # the same pool, so they're all uploaded at once
+            uploads = {}
+            parts = []
+            for (item, entry), upload, error in \
+                    pool.imap_unordered(self._start_multipart_upload, large_files):
+                if error:
+                    done(item[1], None, "uploaded", error)
+                else:
+                    upload.update(entry=entry, etags={}, error=None,
+                                  chunks=self._get_parts(entry[1]))
+                    uploads[item[1]] = upload
+                    parts += [("part", item[1], upload["id"], item[0], part,
+                               upload["parts"].get(part[0]))
+                              for part in upload["chunks"]]
+
+            tasks = []
+            small_files = [("file", item, entry) for item, entry in small_files]
+            for i in range(max(len(parts), len(small_files))):
+                tasks += parts[i:i + 1] + small_files[i:i + 1]
+            tasks += copies
+
+            for task, etag, error in pool.imap_unordered(self._upload_task, tasks):
+                if task[0] in ("file", "copy"):
+                    done(task[1][1], task[2],
+                         "uploaded" if task[0] == "file" else "refreshed", error)
+                    continue
+                s3_path, part = task[1], task[4]
+                upload = uploads[s3_path]
+                upload["error"] = upload["error"] or error
+                upload["etags"][part[0]] = etag
+                if len(upload["etags"]) == len(upload["chunks"]):
+                    error = upload["error"] \
+                        or self._complete_multipart_upload(s3_path, upload)
+                    done(s3_path, upload["entry"], "uploaded", error)
+        finally:
+            pool.close()
+            pool.join()
+
+        local_files = set([f[1] for f in files_list])
+        removed = [k for k in manifest if k not in local_files]
+        exclude_files = exclude_files or []
+        if purge:
+            to_delete = [k for k in removed if k not in exclude_files]
+            result["deleted"] = self._delete_files(to_delete)
+        for k in removed:
+            if k not in result["deleted"]:
+                new_manifest[k] = manifest[k]
 
-        # Save the files that have been uploaded
-        self._set_manifest_data(files_list)
+        self._set_manifest_data(new_manifest)
+        return result
 
     def purge_files(self, exclude_files=["index.html", "error.html"]):
         """
@@ -227,65 +393,500 @@ class S3Website(object):
         :param excludes_files: list : files to not delete
         :return:
         """
-        for chunk in utils.chunk_list(self._get_manifest_data(), 1000):
+        manifest = self._get_manifest_data()
+        deleted = self._delete_files([f for f in manifest
+                                      if f not in exclude_files])
+        self._set_manifest_data(dict([(k, v) for k, v in manifest.items()
+                                      if k not in deleted]))
+
+    def refresh_headers(self, build_dir, progress=None):
+        """
+        Set the headers of the files already uploaded again, from the cache
+        rules, without uploading them: each object is copied onto itself with
+        its new headers. The files that changed since the last upload are
+        skipped, they are left to `upload`
+
+        :param build_dir: The directory that was uploaded
+        :param progress: callable(done, total, s3_path, error) - called after
+                         each file is refreshed, skipped or failed
+        :return: dict of the `refreshed` and `skipped` files, and the list of
+                 tuple(s3_path, error) of the files that `failed`
+        """
+        manifest = self._get_manifest_data()
+        tmp_dir = tempfile.mkdtemp(prefix="yass-upload-") if self.gzip else None
+        try:
+            files_list = [item for item in self._get_files(build_dir, manifest, tmp_dir)
+                          if item[3]]
+            return self._refresh_files(files_list, manifest, progress)
+        finally:
+            if tmp_dir:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _refresh_files(self, files_list, manifest, progress):
+        """
+        Set the headers of the files already uploaded, see refresh_headers()
+        :param files_list: list of tuple(local_path, s3_path, mimetype, manifest entry)
+        :param manifest: dict - the files in the manifest
+        """
+        result = {"refreshed": [], "skipped": [], "failed": []}
+
+        def copy(item):
+            item, entry, error = self._check_file(item)
+            old_entry = item[3]
+            if error or old_entry[0] != entry[0]:
+                return item, None, error
             try:
-                self.s3.delete_objects(
+                self._retry(self._copy_file, item)
+                return item, entry, None
+            except RETRY_ERRORS as e:
+                return item, None, e
+
+        pool = multiprocessing.pool.ThreadPool(self.upload_workers)
+        try:
+            for i, (item, entry, error) in enumerate(pool.imap_unordered(copy, files_list)):
+                if error:
+                    result["failed"].append((item[1], error))
+                elif entry:
+                    result["refreshed"].append(item[1])
+                    manifest[item[1]] = entry
+                else:
+                    result["skipped"].append(item[1])
+                if progress:
+                    progress(i + 1, len(files_list), item[1], error)
+        finally:
+            pool.close()
+            pool.join()
+
+        self._set_manifest_data(manifest)
+        return result
+
+    def _delete_files(self, files):
+        """
+        Delete files, by batch of 1000
+        :param files: list of keys
+        :return: list of the keys deleted
+        """
+        deleted = []
+        for chunk in utils.chunk_list(files, 1000):
+            try:
+                response = self.s3.delete_objects(
                     Bucket=self.sitename,
                     Delete={
-                        'Objects': [{"Key": f} for f in chunk
-                                    if f not in exclude_files]
+                        'Objects': [{"Key": f} for f in chunk]
                     }
                 )
+                errors = set([e["Key"] for e in response.get("Errors", [])])
+                deleted += [f for f in chunk if f not in errors]
             except Exception as ex:
                 pass
+        return deleted
+
+    def manifest_exists(self):
+        """
+        Check if the bucket has a manifest
+        :return: bool
+        """
+        try:
+            self.s3.head_object(Bucket=self.sitename, Key=self.manifest_file)
+            return True
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ["403", "404", "NoSuchKey"]:
+                return False
+            raise e
 
     def create_manifest_from_s3_files(self):
         """
         To create a manifest db for the current
-        :return:
+        The top level of the bucket is listed first, then each of its
+        directories is listed in parallel, page by page. The manifest is saved
+        once everything is listed.
+        The ETag of the objects uploaded at once is the MD5 of their content
+        :return: int - the number of files in the manifest
         """
-        for k in self.s3.list_objects(Bucket=self.sitename)['Contents']:
-            key = k["Key"]
-            files = []
-            if key not in [self.manifest_file]:
-                files.append(key)
-            self._set_manifest_data(files)
+        files = {}
+        prefixes = []
+        for page in self._list_objects(Delimiter="/"):
+            prefixes += [p["Prefix"] for p in page.get("CommonPrefixes", [])]
+            self._add_manifest_objects(files, page)
 
-    def _set_manifest_data(self, files_list):
+        def list_prefix(prefix):
+            _files = {}
+            for page in self._list_objects(Prefix=prefix):
+                self._add_manifest_objects(_files, page)
+            return _files
+
+        if prefixes:
+            pool = multiprocessing.pool.ThreadPool(min(len(prefixes),
+                                                       self.upload_workers))
+            try:
+                for _files in pool.imap_unordered(list_prefix, prefixes):
+                    files.update(_files)
+            finally:
+                pool.close()
+                pool.join()
+
+        self._set_manifest_data(files)
+        return len(files)
+
+    def _list_objects(self, **kwargs):
+        """ Iterate over the pages of the objects of the bucket """
+        paginator = self.s3.get_paginator("list_objects_v2")
+        return paginator.paginate(Bucket=self.sitename, **kwargs)
+
+    def _add_manifest_objects(self, files, page):
+        """ Add the objects of a page of list_objects_v2 to the manifest files """
+        for obj in page.get("Contents", []):
+            if obj["Key"] != self.manifest_file:
+                files[obj["Key"]] = [obj["ETag"].strip('"'), obj["Size"], None]
+
+    def _set_manifest_data(self, files):
         """
         Write manifest files
-        :param files_list: list
+        The manifest is gzipped JSON Lines: a header with the version, then a
+        [key, hash, size, content type, cache rule digest, time the headers
+        were set] line per file, sorted by key.
+        :param files: dict of key -> [hash, size, content type, cache rule
+                      digest, time the headers were set]
         :return:
         """
-        if files_list:
-            data = ",".join(files_list)
-            self.s3.put_object(Bucket=self.sitename,
-                               Key=self.manifest_file,
-                               Body=data,
-                               ACL='private')
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode="wb") as gz:
+            gz.write(json.dumps({"version": self.manifest_version}).encode("utf-8"))
+            for key in sorted(files):
+                entry = files[key] or [None, None, None]
+                gz.write(b"\n" + json.dumps([key] + list(entry)).encode("utf-8"))
+        self.s3.put_object(Bucket=self.sitename,
+                           Key=self.manifest_file,
+                           Body=buf.getvalue(),
+                           ContentType="application/gzip",
+                           ACL='private')
 
     def _get_manifest_data(self):
         """
-        Return the list of items in the manifest
-        :return: list
+        Return the files in the manifest.
+        The manifest is read as it's downloaded. The JSON manifest and the
+        comma separated one of the previous versions are read too, the keys of
+        the comma separated one have no hash.
+        :return: dict of key -> [hash, size, content type, cache rule digest,
+                 time the headers were set]
         """
-        with tempfile.NamedTemporaryFile(delete=True) as tmp:
+        try:
+            body = self.s3.get_object(Bucket=self.sitename,
+                                      Key=self.manifest_file)["Body"]
+        except botocore.exceptions.ClientError:
+            return {}
+
+        chunk = body.read(65536)
+        if not chunk.startswith(b"\x1f\x8b"):
+            data = (chunk + body.read()).decode("utf-8")
+            if not data:
+                return {}
             try:
-                self.s3.download_fileobj(self.sitename, self.manifest_file, tmp)
-                tmp.seek(0)
-                data = tmp.read()
-                if data is not None:
-                    return data.split(",")
-            except Exception as ex:
-                pass
-        return []
+                return json.loads(data)["files"]
+            except (ValueError, KeyError, TypeError):
+                return dict([(k, None) for k in data.split(",")])
+
+        files = {}
+        for line in self._iter_gzip_lines(body, chunk):
+            line = json.loads(line.decode("utf-8"))
+            if isinstance(line, dict):
+                if line.get("version", 0) > self.manifest_version:
+                    raise Exception("The manifest version %s is not supported "
+                                    "by this version of Yass" % line["version"])
+            else:
+                files[line[0]] = line[1:] if line[1] else None
+        return files
 
     @staticmethod
-    def _upload_file(aws_params, bucket_name, local_path, s3_path, mimetype):
-        s3 = boto3.client("s3", **aws_params)
-        s3.upload_file(local_path,
-                       Bucket=bucket_name,
-                       Key=s3_path,
-                       ExtraArgs={"ContentType": mimetype})
+    def _iter_gzip_lines(body, chunk=b"", chunk_size=65536):
+        """
+        Decompress a gzipped stream and yield its lines
+        :param body: file-like object
+        :param chunk: the first chunk, if it's already read
+        :param chunk_size: the size of the chunks to read
+        """
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        rest = b""
+        while True:
+            chunk = chunk or body.read(chunk_size)
+            if not chunk:
+                break
+            lines = (rest + decompressor.decompress(chunk)).split(b"\n")
+            rest = lines.pop()
+            for line in lines:
+                yield line
+            chunk = b""
+        rest += decompressor.flush()
+        for line in rest.split(b"\n"):
+            if line:
+                yield line
 
+    def _get_files(self, build_dir, manifest, tmp_dir=None):
+        """
+        Return the files of the build dir to upload.
+        With gzip, the text files are uploaded from their gzipped copy: the
+        one of `precompress` when it's up to date, or one written in tmp_dir
+        :param build_dir: The directory to upload
+        :param manifest: dict - the files in the manifest
+        :param tmp_dir: the directory to write the gzipped files in
+        :return: list of tuple(local_path, s3_path, mimetype, manifest entry)
+        """
+        variants = tuple(utils.COMPRESS_EXTENSIONS.values())
+        files_list = []
+        for root, dirs, files in os.walk(build_dir):
+            for filename in files:
+                # Yass build files, ie: .yass-graph.json
+                if filename.startswith(".yass-"):
+                    continue
+                local_path = os.path.join(root, filename)
+                # The compressed copies of the files, ie: index.html.gz
+                if local_path.endswith(variants) \
+                        and os.path.isfile(os.path.splitext(local_path)[0]):
+                    continue
+                s3_path = os.path.relpath(local_path, build_dir)
+                mimetype = utils.get_mimetype(local_path)
+                if self.gzip and utils.is_compressible(local_path):
+                    gz_path = local_path + ".gz"
+                    if not os.path.isfile(gz_path) \
+                            or os.path.getmtime(gz_path) < os.path.getmtime(local_path):
+                        gz_path = os.path.join(tmp_dir, s3_path + ".gz")
+                        if not os.path.isdir(os.path.dirname(gz_path)):
+                            os.makedirs(os.path.dirname(gz_path))
+                        utils.compress_file(local_path, gz_path)
+                    local_path = gz_path
+                files_list.append((local_path, s3_path, mimetype,
+                                   manifest.get(s3_path)))
+
+        return files_list
+
+    def _get_cache_rule(self, s3_path):
+        """
+        Return the first cache rule matching a key
+        :return: tuple(headers, digest), None if no rule matches
+        """
+        for regex in self._cache_rules_re:
+            m = regex.match(s3_path)
+            if m:
+                return self.cache_rules[int(m.lastgroup[1:])]
+        return None
 
+    def _get_cache_rule_digest(self, s3_path):
+        """
+        The digest of the cache rule of a key, kept in the manifest
+        :return: string, None if no rule matches
+        """
+        rule = self._get_cache_rule(s3_path)
+        return rule[1] if rule else None
+
+    def _is_expiring(self, s3_path, entry):
+        """
+        If the `expires` in seconds of a key must be set again: when half of
+        it has passed since its headers were set, as kept in its manifest entry
+        :param entry: the manifest entry of the key
+        :return: bool
+        """
+        rule = self._get_cache_rule(s3_path)
+        expires = rule[0].get("expires") if rule else None
+        if not isinstance(expires, int) or expires <= 0:
+            return False
+        headers_time = (entry[4:] or [None])[0]
+        return not headers_time or time.time() - headers_time >= expires / 2.0
+
+    @staticmethod
+    def _parse_expires(expires):
+        """
+        The `expires` of a cache rule: seconds from the upload, or a date.
+        The YAML dates are loaded as date, and date and time without a
+        timezone are in UTC
+        :return: int, or datetime with its timezone
+        """
+        if expires is None or (isinstance(expires, int) and not isinstance(expires, bool)):
+            return expires
+        if isinstance(expires, datetime.date) and not isinstance(expires, datetime.datetime):
+            expires = datetime.datetime(expires.year, expires.month, expires.day)
+        try:
+            return botocore.utils.parse_to_aware_datetime(expires)
+        except (ValueError, TypeError):
+            raise ValueError("Invalid `expires` in the cache rules: %s. It must "
+                             "be the seconds from the upload, or a date" % expires)
+
+    def _check_file(self, item):
+        """
+        Hash a file to upload
+        :param item: tuple(local_path, s3_path, mimetype, manifest entry)
+        :return: tuple(item, entry, error) - entry is [hash, size, content type,
+                 cache rule digest, time the headers are set]
+        """
+        local_path, s3_path, mimetype, _ = item
+        try:
+            return item, [utils.hash_file(local_path),
+                          os.path.getsize(local_path),
+                          mimetype,
+                          self._get_cache_rule_digest(s3_path),
+                          int(time.time())], None
+        except (IOError, OSError) as e:
+            return item, None, e
+
+    def _get_extra_args(self, item):
+        """
+        The headers of an object to upload
+        :param item: tuple(local_path, s3_path, mimetype, old_entry)
+        """
+        local_path, s3_path, mimetype, _ = item
+        args = {"ContentType": mimetype}
+        # The gzipped copy of a file, uploaded in its place
+        if local_path.endswith(".gz") and not s3_path.endswith(".gz"):
+            args["ContentEncoding"] = "gzip"
+        rule = self._get_cache_rule(s3_path)
+        if rule:
+            headers = rule[0]
+            if headers.get("cache_control"):
+                args["CacheControl"] = headers["cache_control"]
+            expires = headers.get("expires")
+            # Seconds from now, or a date, see _parse_expires()
+            if isinstance(expires, int):
+                args["Expires"] = datetime.datetime.utcnow() \
+                    + datetime.timedelta(seconds=expires)
+            elif expires:
+                args["Expires"] = expires
+            if headers.get("metadata"):
+                args["Metadata"] = dict([(str(k), str(v)) for k, v
+                                         in headers["metadata"].items()])
+        return args
+
+    def _upload_task(self, task):
+        """
+        Run an upload task, in the pool
+        ("file", item, entry): upload a whole file
+        ("copy", item, entry): set the headers of a file already uploaded
+        ("part", s3_path, upload_id, local_path, part, uploaded): upload a part
+        :return: tuple(task, etag, error)
+        """
+        try:
+            if task[0] in ("file", "copy"):
+                self._retry(self._put_file if task[0] == "file"
+                            else self._copy_file, task[1])
+                return task, None, None
+            return task, self._upload_part(*task[1:]), None
+        except RETRY_ERRORS as e:
+            return task, None, e
+
+    def _put_file(self, item):
+        """ Upload a whole file """
+        local_path, s3_path, mimetype, _ = item
+        with open(local_path, "rb") as f:
+            self.s3.put_object(Bucket=self.sitename,
+                               Key=s3_path,
+                               Body=f,
+                               **self._get_extra_args(item))
+
+    def _copy_file(self, item):
+        """ Set the headers of a file already uploaded, by copying it onto itself """
+        s3_path = item[1]
+        self.s3.copy_object(Bucket=self.sitename,
+                            Key=s3_path,
+                            CopySource={"Bucket": self.sitename, "Key": s3_path},
+                            MetadataDirective="REPLACE",
+                            **self._get_extra_args(item))
+
+    def _get_parts(self, size):
+        """ Return the (number, offset, size) of each part of a file """
+        return [(i + 1, offset, min(self.multipart_chunksize, size - offset))
+                for i, offset in enumerate(range(0, size, self.multipart_chunksize))]
+
+    def _start_multipart_upload(self, file):
+        """
+        Start the multipart upload of a file, or resume the last one that was
+        interrupted. The older ones left are aborted.
+        :param file: tuple(item, entry)
+        :return: tuple(file, upload, error) - upload is a dict of the upload
+                 `id`, and of the `parts` already uploaded: number -> (etag, size)
+        """
+        item, entry = file
+        local_path, s3_path, mimetype, _ = item
+        try:
+            response = self._retry(self.s3.list_multipart_uploads,
+                                   Bucket=self.sitename,
+                                   Prefix=s3_path)
+            pending = sorted([u for u in response.get("Uploads", [])
+                              if u["Key"] == s3_path],
+                             key=lambda u: u["Initiated"])
+            for u in pending[:-1]:
+                self._retry(self.s3.abort_multipart_upload,
+                            Bucket=self.sitename,
+                            Key=s3_path,
+                            UploadId=u["UploadId"])
+            parts = {}
+            if pending:
+                upload_id = pending[-1]["UploadId"]
+                paginator = self.s3.get_paginator("list_parts")
+                for page in paginator.paginate(Bucket=self.sitename,
+                                               Key=s3_path,
+                                               UploadId=upload_id):
+                    for part in page.get("Parts", []):
+                        parts[part["PartNumber"]] = (part["ETag"].strip('"'),
+                                                     part["Size"])
+            else:
+                upload_id = self._retry(self.s3.create_multipart_upload,
+                                        Bucket=self.sitename,
+                                        Key=s3_path,
+                                        **self._get_extra_args(item))["UploadId"]
+            return file, {"id": upload_id, "parts": parts}, None
+        except RETRY_ERRORS as e:
+            return file, None, e
+
+    def _upload_part(self, s3_path, upload_id, local_path, part, uploaded):
+        """
+        Upload a part of a file, unless it was already uploaded with the same
+        content, by an interrupted upload
+        :param part: tuple(number, offset, size)
+        :param uploaded: tuple(etag, size) of the part already uploaded, or None
+        :return: the ETag of the part
+        """
+        number, offset, size = part
+        with open(local_path, "rb") as f:
+            f.seek(offset)
+            data = f.read(size)
+        etag = hashlib.md5(data).hexdigest()
+        if uploaded != (etag, size):
+            response = self._retry(self.s3.upload_part,
+                                   Bucket=self.sitename,
+                                   Key=s3_path,
+                                   UploadId=upload_id,
+                                   PartNumber=number,
+                                   Body=data)
+            etag = response["ETag"].strip('"')
+        return etag
+
+    def _complete_multipart_upload(self, s3_path, upload):
+        """
+        Complete a multipart upload, once all its parts are uploaded
+        :return: the error, None if it's completed
+        """
+        try:
+            self._retry(self.s3.complete_multipart_upload,
+                        Bucket=self.sitename,
+                        Key=s3_path,
+                        UploadId=upload["id"],
+                        MultipartUpload={
+                            "Parts": [{"PartNumber": n, "ETag": '"%s"' % etag}
+                                      for n, etag in sorted(upload["etags"].items())]
+                        })
+        except RETRY_ERRORS as e:
+            return e
+        return None
+
+    def _retry(self, func, *args, **kwargs):
+        """
+        Call an S3 operation, retrying with an exponential backoff when it fails
+        :return: the result of the operation
+        """
+        error = None
+        for attempt in range(self.upload_retries + 1):
+            if attempt:
+                time.sleep(0.5 * 2 ** (attempt - 1))
+            try:
+                return func(*args, **kwargs)
+            except RETRY_ERRORS as e:
+                error = e
+        raise error
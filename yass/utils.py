@@ -1,9 +1,38 @@
 
+import io
 import os
 import re
+import sys
+import csv
+import json
+import gzip
 import yaml
+import shutil
+import hashlib
+import tempfile
 import mimetypes
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import toml
+except ImportError:
+    toml = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# The libyaml loader is much faster, when PyYAML is built with it
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# The Linux ioctl to clone a file, see copy_file()
+FICLONE = 0x40049409
+
 
 MIMETYPE_MAP = {
     '.js':   'application/javascript',
@@ -21,6 +50,23 @@ MIMETYPE_MAP = {
 MIMETYPE_DEFAULT = 'application/octet-stream'
 
 
+# The content types worth compressing
+COMPRESSIBLE_TYPES = ("text/",
+                      "application/javascript",
+                      "application/json",
+                      "application/xml",
+                      "image/svg+xml",
+                      "application/vnd.ms-fontobject",
+                      "application/x-font-truetype",
+                      "application/x-font-opentype")
+
+# The file extension of each content encoding
+COMPRESS_EXTENSIONS = {
+    "gzip": ".gz",
+    "br": ".br"
+}
+
+
 def get_mimetype(filename):
     mimetype, _ = mimetypes.guess_type(filename)
     if mimetype:
@@ -55,6 +101,90 @@ class dictdot(dict):
             return default
 
 
+class trackeddict(dictdot):
+    """
+    A dictdot that can record the top level keys being accessed.
+    Used to find out which data a page depends on while it's rendered.
+    ie:
+        d.track()
+        d.get('posts.all')
+        d.untrack() -> set(['posts'])
+    """
+    _accessed = None
+
+    def track(self):
+        """ Start recording the keys accessed """
+        self._accessed = set()
+
+    def untrack(self):
+        """ Stop recording and return the keys accessed since track() """
+        accessed = self._accessed or set()
+        self._accessed = None
+        return accessed
+
+    def __getitem__(self, key):
+        if self._accessed is not None:
+            self._accessed.add(key)
+        return super(trackeddict, self).__getitem__(key)
+
+
+class lazydict(trackeddict):
+    """
+    A trackeddict whose values are loaded the first time they are accessed.
+    ie:
+        d = lazydict()
+        d.set_loader('posts', lambda: json.load(open('posts.json')))
+        d.get('posts.0.title') -> loads posts, once
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(lazydict, self).__init__(*args, **kwargs)
+        self._loaders = {}
+
+    def set_loader(self, key, loader):
+        """
+        Set the loader of a key. A value already loaded is dropped, and will
+        be loaded again on the next access
+        :param key: the key
+        :param loader: callable returning the value of the key
+        """
+        dict.pop(self, key, None)
+        self._loaders[key] = loader
+
+    def unset(self, key):
+        """ Remove a key, whether it's loaded or not """
+        dict.pop(self, key, None)
+        self._loaders.pop(key, None)
+
+    def __missing__(self, key):
+        if key not in self._loaders:
+            raise KeyError(key)
+        # The loader is kept until it succeeds, so a failure is raised again
+        value = self._loaders[key]()
+        self._loaders.pop(key, None)
+        dict.__setitem__(self, key, value)
+        return value
+
+    def __contains__(self, key):
+        return key in self._loaders or dict.__contains__(self, key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        return list(dict.keys(self)) + [k for k in self._loaders
+                                        if not dict.__contains__(self, k)]
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+
 def load_conf(yml_file, conf={}):
     """
     To load the config
@@ -63,12 +193,260 @@ def load_conf(yml_file, conf={}):
     :return: dict
     """
     with open(yml_file) as f:
-        data = yaml.load(f)
+        data = load_yaml(f)
         if conf:
             data.update(conf)
         return dictdot(data)
 
 
+class FileCache(object):
+    """
+    A key/value cache on disk. Each value is pickled in its own file.
+    The version is part of the key, so a new version starts a fresh cache.
+    ie:
+        cache = FileCache("/path/to/cache", "1.0")
+        cache.set("md:hash", value)
+        cache.get("md:hash")
+    """
+
+    def __init__(self, directory, version=""):
+        self.directory = directory
+        self.version = version
+
+    def _get_filename(self, key):
+        h = hash_content("%s:%s" % (self.version, key))
+        return os.path.join(self.directory, h[:2], h)
+
+    def get(self, key, default=None):
+        """ Return the cached value, or default if it's missing or unreadable """
+        try:
+            with open(self._get_filename(key), "rb") as f:
+                return pickle.load(f)
+        except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return default
+
+    def set(self, key, value):
+        """ Cache a value. It's written to a temp file first, as workers share the cache """
+        filename = self._get_filename(key)
+        try:
+            os.makedirs(os.path.dirname(filename))
+        except OSError:
+            pass
+        tmp_file = "%s.%s.tmp" % (filename, os.getpid())
+        with open(tmp_file, "wb") as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        try:
+            os.rename(tmp_file, filename)
+        except OSError:
+            os.remove(tmp_file)
+
+
+def get_mtimes(directory):
+    """
+    Return the modification time of every file in a directory
+    :param directory:
+    :return: dict {filepath: mtime}
+    """
+    mtimes = {}
+    for root, _, files in os.walk(directory):
+        for f in files:
+            filepath = os.path.join(root, f)
+            try:
+                mtimes[filepath] = os.path.getmtime(filepath)
+            except OSError:
+                pass
+    return mtimes
+
+
+def hash_content(content):
+    """
+    Return the hexdigest of a content
+    :param content: string
+    :return: string
+    """
+    if not isinstance(content, bytes):
+        content = content.encode("utf-8")
+    return hashlib.md5(content).hexdigest()
+
+
+def hash_file(filepath):
+    """
+    Return the hexdigest of a file content, None if the file doesn't exist
+    :param filepath: the file path
+    :return: string
+    """
+    if not os.path.isfile(filepath):
+        return None
+    h = hashlib.md5()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class HashedFile(object):
+    """
+    A text file streamed to a temp file, and hashed as it's written.
+    It's saved in place of the file only if its hash changed, so a file that
+    didn't change is left as is.
+    ie:
+        f = HashedFile("/path/to/dir")
+        f.write(u"...")
+        f.save("/path/to/dir/file.xml", old_hash)
+    """
+
+    def __init__(self, directory):
+        fd, self.tmp_file = tempfile.mkstemp(prefix=".yass-", suffix=".tmp",
+                                             dir=directory)
+        self._file = io.open(fd, "w", encoding="utf-8")
+        self._hash = hashlib.md5()
+
+    def write(self, text):
+        self._hash.update(text.encode("utf-8"))
+        self._file.write(text)
+
+    def save(self, filepath, old_hash=None):
+        """
+        Move the file written to filepath, unless it has the old hash
+        :return: string - the hexdigest of the content
+        """
+        self._file.close()
+        h = self._hash.hexdigest()
+        if h == old_hash and os.path.isfile(filepath):
+            os.remove(self.tmp_file)
+        else:
+            os.rename(self.tmp_file, filepath)
+        return h
+
+
+def is_compressible(filename):
+    """ If the content type of a file is worth compressing """
+    return get_mimetype(filename).startswith(COMPRESSIBLE_TYPES)
+
+
+def glob_to_regex(pattern):
+    """
+    Translate a glob to a regex matching the paths, relative to the root.
+    `*` and `?` don't match `/`, `**` matches any number of directories.
+    A glob without `/` matches the file name in any directory, ie: `*.html`
+    :param pattern: the glob, ie: static/vendor/**
+    :return: string - the regex
+    """
+    regex = "" if "/" in pattern else "(?:.*/)?"
+    pattern = pattern.lstrip("/")
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        else:
+            c = pattern[i]
+            regex += "[^/]*" if c == "*" else "[^/]" if c == "?" else re.escape(c)
+            i += 1
+    return regex
+
+
+def compress_file(src, dest, encoding="gzip"):
+    """
+    Write the compressed content of a file.
+    gzip files have no mtime, so the same content always gives the same file
+    :param src: the file to compress
+    :param dest: the compressed file
+    :param encoding: gzip | br - br requires the `brotli` package
+    """
+    with open(src, "rb") as f:
+        data = f.read()
+    if encoding == "br":
+        if brotli is None:
+            raise ImportError("Brotli requires the `brotli` package: pip install brotli")
+        data = brotli.compress(data)
+    else:
+        buf = io.BytesIO()
+        with gzip.GzipFile(filename="", fileobj=buf, mode="wb",
+                           compresslevel=9, mtime=0) as gz:
+            gz.write(data)
+        data = buf.getvalue()
+    with open(dest, "wb") as f:
+        f.write(data)
+
+
+def fingerprint_name(filepath, h, length=12):
+    """
+    Add a content hash to a file name. ie: css/style.css -> css/style.<hash>.css
+    :param filepath: the file path
+    :param h: the hash of the file content
+    :param length: the number of characters of the hash to use
+    :return: string
+    """
+    base, ext = os.path.splitext(filepath)
+    return "%s.%s%s" % (base, h[:length], ext)
+
+
+def copy_file(src, dest, mode="copy"):
+    """
+    Copy a file, or link it to the source
+    :param src: the source file
+    :param dest: the destination file, replaced if it exists
+    :param mode: copy | hardlink | reflink - reflink clones the file, copy on
+                 write, where the filesystem supports it. Fall back to copy
+    """
+    dest_dir = os.path.dirname(dest)
+    if dest_dir and not os.path.isdir(dest_dir):
+        os.makedirs(dest_dir)
+    if os.path.lexists(dest):
+        os.remove(dest)
+    if mode == "hardlink":
+        try:
+            os.link(src, dest)
+            return
+        except (OSError, AttributeError):
+            pass
+    elif mode == "reflink":
+        if _reflink(src, dest):
+            return
+    shutil.copy2(src, dest)
+
+
+def _reflink(src, dest):
+    """ Clone a file with the Linux FICLONE ioctl """
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        with open(src, "rb") as fs, open(dest, "wb") as fd:
+            fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+    except (IOError, OSError):
+        if os.path.exists(dest):
+            os.remove(dest)
+        return False
+    shutil.copystat(src, dest)
+    return True
+
+
+def load_yaml(stream):
+    """
+    Parse YAML with the fastest safe loader available
+    :param stream: string or file
+    :return: the data
+    """
+    return yaml.load(stream, Loader=YAML_LOADER)
+
+
+def load_toml(stream):
+    """
+    Parse TOML. Requires the `toml` package
+    :param stream: file
+    :return: dict
+    """
+    if toml is None:
+        raise ImportError("TOML files require the `toml` package: pip install toml")
+    return toml.load(stream)
+
+
 def extract_sitename(s):
     return re.sub(r"https?://(www\.)?", '', s).replace("www.", "")
 
@@ -84,6 +462,133 @@ def chunk_list(items, size):
     return [items[i:i + size] for i in range(0, len(items), size)]
 
 
+def chunk_iter(items, size):
+    """
+    Yield chunks from an iterable, without loading it all in memory
+    :param items: iterable
+    :param size: int The number of items per chunk
+    :return: generator of lists
+    """
+    size = max(1, size)
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# The whitespace between the JSON values
+JSON_WHITESPACE_RE = re.compile(r"[ \t\n\r]*")
+
+
+class DataStream(object):
+    """
+    A data file read item by item, each time it's iterated over, so large
+    data sources don't have to fit in memory.
+    Supports JSON Lines (.jsonl, .ndjson), CSV (.csv, with a header row)
+    and JSON arrays (.json)
+    ie:
+        for item in DataStream("data/products.jsonl"):
+            ...
+    """
+    FORMATS = (".jsonl", ".ndjson", ".csv", ".json")
+
+    def __init__(self, filepath, chunk_size=65536):
+        self.filepath = filepath
+        self.chunk_size = chunk_size
+        self._len = None
+
+    def __iter__(self):
+        ext = os.path.splitext(self.filepath)[1].lower()
+        if ext == ".csv":
+            items = self._iter_csv()
+        elif ext == ".json":
+            items = self._iter_json_array()
+        else:
+            items = self._iter_json_lines()
+        for item in items:
+            if isinstance(item, dict):
+                item = dictdot(item)
+            yield item
+
+    def count(self):
+        """ The number of items. The file is read once to count them """
+        if self._len is None:
+            self._len = sum(1 for _ in self)
+        return self._len
+
+    def _iter_json_lines(self):
+        with io.open(self.filepath, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+    def _iter_csv(self):
+        if sys.version_info[0] < 3:
+            with open(self.filepath, "rb") as f:
+                for row in csv.DictReader(f):
+                    yield dict([(k.decode("utf-8"), v.decode("utf-8") if v else v)
+                                for k, v in row.items()])
+        else:
+            with io.open(self.filepath, encoding="utf-8", newline="") as f:
+                for row in csv.DictReader(f):
+                    yield row
+
+    def _iter_json_array(self):
+        """
+        Decode the items of a JSON array one at a time, chunk by chunk.
+        The items are decoded from an index in the buffer, which is only
+        compacted when a chunk is read
+        """
+        decoder = json.JSONDecoder()
+        with io.open(self.filepath, encoding="utf-8") as f:
+            buf = u""
+            idx = 0
+            eof = False
+            started = False
+            while True:
+                idx = JSON_WHITESPACE_RE.match(buf, idx).end()
+                if idx < len(buf):
+                    c = buf[idx]
+                    if not started:
+                        if c != "[":
+                            raise ValueError("%s is not a JSON array" % self.filepath)
+                        idx += 1
+                        started = True
+                        continue
+                    if c == ",":
+                        idx += 1
+                        continue
+                    if c == "]":
+                        return
+                    end = None
+                    try:
+                        item, end = decoder.raw_decode(buf, idx)
+                        # The item is complete once followed by `,` or `]`,
+                        # ie: a number may continue in the next chunk
+                        rest = JSON_WHITESPACE_RE.match(buf, end).end()
+                        if not eof and (rest == len(buf) or buf[rest] not in ",]"):
+                            end = None
+                    except ValueError:
+                        if eof:
+                            raise
+                    if end is not None:
+                        yield item
+                        idx = end
+                        continue
+                if eof:
+                    raise ValueError("%s is not a valid JSON array" % self.filepath)
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    eof = True
+                buf = buf[idx:] + chunk
+                idx = 0
+
+
 
 #---
 
@@ -2,25 +2,33 @@
 ~ Yass ~
 """
 
+import io
 import os
 import re
 import sys
-import copy
 import json
 import time
+import heapq
 import yaml
 import arrow
 import shutil
+import string
+import functools
+import itertools
 import jinja2
+import jinja2.meta
 import logging
 import requests
+import collections
+import multiprocessing
+import multiprocessing.pool
 import frontmatter
 import pkg_resources
 import webassets.loaders
 from slugify import slugify
-from extras import (jade, md)
+from xml.sax.saxutils import escape
+from extras import (jade, md, htmlmin)
 from paginator import Paginator
-from distutils.dir_util import copy_tree
 from webassets import Environment as WAEnv
 from webassets.ext.jinja2 import AssetsExtension
 from webassets.script import CommandLineEnvironment
@@ -33,8 +41,85 @@ NAME = "Yass"
 
 PAGE_FORMAT = (".html", ".md", ".jade")
 
+DATA_FORMAT = (".json", ".yml", ".yaml", ".toml")
+
 DEFAULT_LAYOUT = "layouts/default.jade"
 
+# The directory to cache compiled templates and converted content across builds
+CACHE_DIR = ".yass-cache"
+
+# The dependency graph of the last build, saved in the build dir
+BUILD_GRAPH_FILE = ".yass-graph.json"
+BUILD_GRAPH_VERSION = 3
+# The index of the pages for the sitemap and the feed, a line per page source
+SITE_INDEX_FILE = ".yass-index.jsonl"
+STATIC_MANIFEST_FILE = ".yass-static.json"
+ASSETS_MANIFEST_FILE = "assets-manifest.json"
+COMPRESS_MANIFEST_FILE = ".yass-compress.json"
+
+# The most urls a sitemap file can have
+SITEMAP_MAX_URLS = 50000
+
+# The config of how the site is built, not of what is built: changing it
+# doesn't rebuild the pages
+RUNTIME_CONFIG = ["workers", "cache", "cache_dir", "data_api_offline",
+                  "data_api_cache_ttl", "data_api_timeout", "static_sync",
+                  "precompress"]
+
+# A page source read once by the scan: the meta, the content without the
+# frontmatter, and the hash of the source
+PageRecord = collections.namedtuple("PageRecord", ["meta", "content", "hash"])
+
+# The Yass instance of a build worker process
+_worker = None
+
+
+def _init_worker(root_dir, config, pages_meta, data_api):
+    """ Set up the Yass instance of a build worker process, once per worker """
+    global _worker
+    _worker = Yass(root_dir, config)
+    _worker._pages_meta.update(pages_meta)
+    _worker._data_api.update(data_api)
+
+
+def _build_page_worker(page):
+    """ Build a page in a worker process. page is a (filepath, PageRecord) """
+    filepath, record = page
+    _worker._pages[filepath] = record
+    return filepath, _worker._build_page(filepath)
+
+
+class TemplateBytecodeCache(jinja2.FileSystemBytecodeCache):
+    """
+    Cache the compiled templates on disk, so unchanged templates are not
+    preprocessed (jade, markdown, htmlcompress) and compiled on every build.
+    The checksum of a template is made of its source and of the version of
+    Yass and the extensions, so upgrading any of them invalidates the cache.
+    """
+
+    def __init__(self, directory, version):
+        super(TemplateBytecodeCache, self).__init__(directory, "%s.cache")
+        self.version = version
+
+    def get_source_checksum(self, source):
+        return super(TemplateBytecodeCache, self)\
+            .get_source_checksum(self.version + source)
+
+    def dump_bytecode(self, bucket):
+        # Written to a temp file first, as build workers share the cache
+        try:
+            os.makedirs(self.directory)
+        except OSError:
+            pass
+        filename = self._get_cache_filename(bucket)
+        tmp_file = "%s.%s.tmp" % (filename, os.getpid())
+        with open(tmp_file, "wb") as f:
+            bucket.write_bytecode(f)
+        try:
+            os.rename(tmp_file, filename)
+        except OSError:
+            os.remove(tmp_file)
+
 # ==============================================================================
 # -------------------------------- YASS ----------------------------------------
 # ==============================================================================
@@ -59,6 +144,10 @@ class Yass(object):
     tpl_env = None
     _templates = {}
     _pages_meta = {}
+    _page_deps = None
+    _page_outputs = None
+    _page_index = None
+    _page_only = None
 
     def __init__(self, root_dir, config=None):
         """
@@ -68,6 +157,7 @@ class Yass(object):
         """
 
         self.root_dir = root_dir
+        self._init_config = config
         self.build_dir = os.path.join(self.root_dir, "build")
         self.static_dir = os.path.join(self.root_dir, "static")
         self.content_dir = os.path.join(self.root_dir, "content")
@@ -75,18 +165,45 @@ class Yass(object):
         self.templates_dir = os.path.join(self.root_dir, "templates")
         self.data_dir = os.path.join(self.root_dir, "data")
         self.build_static_dir = os.path.join(self.build_dir, "static")
+        self.build_graph_file = os.path.join(self.build_dir, BUILD_GRAPH_FILE)
+        self.site_index_file = os.path.join(self.build_dir, SITE_INDEX_FILE)
 
         config_file = os.path.join(self.root_dir, "yass.yml")
         self.config = utils.load_conf(config_file, config)
 
+        self.cache_dir = os.path.join(self.root_dir,
+                                      self.config.get("cache_dir") or CACHE_DIR)
+        self.cache_enabled = self.config.get("cache", True) is not False
+        self.html_minify = self.config.get("html_minify") is True
+        self.cache_version = self._get_cache_version()
+        self.cache = None
+        self.http_cache = None
+        if self.cache_enabled:
+            self.cache = utils.FileCache(os.path.join(self.cache_dir, "content"),
+                                         self.cache_version)
+            self.http_cache = utils.FileCache(os.path.join(self.cache_dir, "http"))
+
         self.default_layout = self.config.get("default_layout", DEFAULT_LAYOUT)
 
-        self.site_config = utils.dictdot(self.config.get("site", {}))
+        self.site_config = utils.trackeddict(self.config.get("site", {}))
         self.site_config.setdefault("base_url", "/")
         self.base_url = self.site_config.get("base_url")
 
         self.sitename = utils.extract_sitename(self.config.get("sitename"))
 
+        self._pages = {}
+        self._pages_urls = {}
+        self._page_templates = {}
+        self._data_sources = {}
+        self._data_api = {}
+        self._data_api_session = None
+        self._dep_hashes = {}
+        self._template_refs = {}
+        self._static_manifest = None
+        self._lazy_graph = {"sources": {}, "inputs": {}}
+        self._lazy_outputs = set()
+        self._page_minify = None
+        self.minify_report = None
         self._data = self._load_data()
         self._init_jinja({
             "site": self.site_config,
@@ -107,6 +224,19 @@ class Yass(object):
             "YEAR": utc.year
         }
 
+    def _get_cache_version(self):
+        """ The version of Yass and the libraries that compile the content """
+        versions = [__version__]
+        for dist in ["jinja2", "pyjade", "markdown", "webassets"]:
+            try:
+                versions.append(pkg_resources.get_distribution(dist).version)
+            except pkg_resources.DistributionNotFound:
+                versions.append("")
+        # The templates are not compressed at compile time when minified
+        if self.html_minify:
+            versions.append("htmlmin")
+        return "-".join(versions)
+
     def _init_jinja(self, global_context={}):
 
         loader = jinja2.ChoiceLoader([
@@ -117,22 +247,79 @@ class Yass(object):
             jinja2.FileSystemLoader(self.templates_dir)
         ])
 
+        bytecode_cache = None
+        if self.cache_enabled:
+            bytecode_cache = TemplateBytecodeCache(
+                os.path.join(self.cache_dir, "templates"),
+                self.cache_version)
+
+        extensions = [
+            'yass.extras.jade.PyJadeExtension',
+            'yass.extras.htmlcompress.HTMLCompress',
+            'yass.extras.jade.JadeTagExtension',
+            'yass.extras.md.MarkdownExtension',
+            'yass.extras.md.MarkdownTagExtension',
+            AssetsExtension
+        ]
+        # The pages are minified once rendered instead
+        if self.html_minify:
+            extensions.remove('yass.extras.htmlcompress.HTMLCompress')
         self.tpl_env = jinja2.Environment(loader=loader,
-                                          extensions=[
-                                              'pyjade.ext.jinja.PyJadeExtension',
-                                              'yass.extras.htmlcompress.HTMLCompress',
-                                              'yass.extras.jade.JadeTagExtension',
-                                              'yass.extras.md.MarkdownExtension',
-                                              'yass.extras.md.MarkdownTagExtension',
-                                              AssetsExtension
-                                          ])
+                                          bytecode_cache=bytecode_cache,
+                                          extensions=extensions)
+        self.tpl_env.extend(jade_cache=self.cache)
         self.tpl_env.globals.update(global_context)
+        self.tpl_env.globals["yass_pages"] = self._get_pages
+        # The links are context filters so they are resolved when the page is
+        # rendered, not folded at compile time, to track the pages they link to
         self.tpl_env.filters.update({
             "format_datetime": lambda dt, format: arrow.get(dt).format(format),
-            "yass_link_to": self._link_to,  # link for a
-            "yass_url_to": self._url_to  # url for a page
+            "yass_link_to": jinja2.contextfilter(
+                lambda ctx, page, *a, **kw: self._link_to(page, *a, **kw)),  # link for a
+            "yass_url_to": jinja2.contextfilter(
+                lambda ctx, page: self._url_to(page)),  # url for a page
+            "yass_static_url": jinja2.contextfilter(
+                lambda ctx, path: self._static_url(path))  # url for a static file
         })
 
+    def scan_pages(self):
+        """
+        Read all the pages once, before rendering, to collect the meta, the
+        content and the url of every page.
+        """
+        self._pages = {}
+        self._pages_urls = {}
+        self._pages_meta = {}
+        for page in self._get_page_files():
+            self._scan_page(page)
+
+    def _scan_page(self, page):
+        """
+        Read and parse a page source, and assign the new meta keys
+        :param page: the page, relative to pages_dir
+        :return: PageRecord
+        """
+        src_file = os.path.join(self.pages_dir, page)
+        with open(src_file) as f:
+            source = f.read()
+        _, _ext = os.path.splitext(src_file)
+        markup = _ext.replace(".", "")
+        _meta, content = frontmatter.parse(source)
+        meta = self.default_page_meta.copy()
+        meta["meta"].update(self.config.get("site.meta", {}))
+        meta.update(_meta)
+        dest_file, url = self._get_dest_file_and_url(page, meta)
+        meta["url"] = url
+        meta["filepath"] = dest_file
+        if meta.get("markup") is None:
+            meta["markup"] = markup
+
+        record = PageRecord(meta, content, utils.hash_content(source))
+        self._pages[page] = record
+        self._pages_meta[page] = meta
+        self._pages_urls[url] = page
+        return record
+
     def _get_page_meta(self, page):
         """
         Cache the page meta from the frontmatter and assign new keys
@@ -140,29 +327,29 @@ class Yass(object):
         """
         meta = self._pages_meta.get(page)
         if not meta:
-            src_file = os.path.join(self.pages_dir, page)
-            with open(src_file) as f:
-                _, _ext = os.path.splitext(src_file)
-                markup = _ext.replace(".", "")
-                _meta, _ = frontmatter.parse(f.read())
-                meta = self.default_page_meta.copy()
-                meta["meta"].update(self.config.get("site.meta", {}))
-                meta.update(_meta)
-                dest_file, url = self._get_dest_file_and_url(page, meta)
-                meta["url"] = url
-                meta["filepath"] = dest_file
-                if meta.get("markup") is None:
-                    meta["markup"] = markup
-                self._pages_meta[page] = meta
-
+            meta = self._scan_page(page).meta
         return meta
 
     def _get_page_content(self, page):
         """ Get the page content without the frontmatter """
-        src_file = os.path.join(self.pages_dir, page)
-        with open(src_file) as f:
-            _meta, content = frontmatter.parse(f.read())
-            return content
+        record = self._pages.get(page) or self._scan_page(page)
+        return record.content
+
+    def _get_pages(self, section=None):
+        """
+        Return the meta of the pages, sorted by their source file.
+        Generator pages are excluded. In the template: yass_pages('blog')
+        :param section: the directory of the pages, relative to pages_dir
+        :return: list
+        """
+        section = (section or "").strip("/")
+        pages = [p for p in sorted(self._pages_meta)
+                 if not self._pages_meta[p].get("_generator")
+                 and (not section or p.startswith(section + "/"))]
+        if self._page_deps is not None:
+            self._page_deps.add("section:%s" % section)
+            self._page_deps.update(["meta:%s" % p for p in pages])
+        return [self._pages_meta[p] for p in pages]
 
     def _link_to(self, page, text=None, title=None, _class="", id="", alt="", **kwargs):
         """ Build the A HREF LINK To a page."""
@@ -171,6 +358,8 @@ class Yass(object):
             page, anchor = page.split("#")
             anchor = "#" + anchor
         meta = self._get_page_meta(page)
+        if self._page_deps is not None:
+            self._page_deps.add("meta:%s" % page)
         return "<a href='{url}' class='{_class}' id='{id}'  title=\"{title}\">{text}</a>".format(
             url=meta.get("url", "/") + anchor,
             text=text or meta.get("title") or title,
@@ -186,6 +375,8 @@ class Yass(object):
             page, anchor = page.split("#")
             anchor = "#" + anchor
         meta = self._get_page_meta(page)
+        if self._page_deps is not None:
+            self._page_deps.add("meta:%s" % page)
         return meta.get("url")
 
     def _get_dest_file_and_url(self, filepath, page_meta={}):
@@ -211,41 +402,180 @@ class Yass(object):
         return dest_file, url
 
     def _load_data(self):
+        """
+        Set up the data namespace. Each data file and API url is only loaded
+        the first time it's accessed, by a template or a generator.
+        :return: utils.lazydict
+        """
+        data = utils.lazydict()
 
-        data = {}
-
-        # Load data from the data directory
+        # Data from the data directory
         for root, _, files in os.walk(self.data_dir):
             for fname in files:
-                if fname.endswith((".json",)):
-                    name = fname.replace(".json", "")
-                    fname = os.path.join(root, fname)
-                    if os.path.isfile(fname):
-                        with open(fname) as f:
-                            _ = json.load(f)
-                            if isinstance(_, dict):
-                                _ = utils.dictdot(_)
-                            data[name] = _
+                name, ext = os.path.splitext(fname)
+                fname = os.path.join(root, fname)
+                if ext in DATA_FORMAT or ext in utils.DataStream.FORMATS:
+                    data.set_loader(name, functools.partial(self._load_data_file, fname))
+                    self._data_sources[name] = fname
 
         # data_api_urls
-        # Doing API call to retrieve the data and assign it to its key
-        # Data must be JSON
         data_api_urls = self.site_config.get("data_api_urls")
         if data_api_urls:
             for name, url in data_api_urls.items():
-                try:
-                    r = requests.get(url)
-                    if r.status_code == 200:
-                        _ = r.json()
-                        if isinstance(_, dict):
-                            _ = utils.dictdot(_)
-                        data[name] = _
-                    else:
-                        raise Exception("`%s -> %s` returns status code %s" % (name, url, r.status_code))
-                except Exception as e:
-                    raise Exception("Data API URLS Error: %s" % e)
+                data.set_loader(name, functools.partial(self._load_data_api, name, url))
+                self._data_sources[name] = None
 
-        return utils.dictdot(data)
+        return data
+
+    def _load_data_file(self, fname):
+        """
+        Load a data file.
+        JSON Lines and CSV files are streamed, and read item by item
+        """
+        _, ext = os.path.splitext(fname)
+        if ext not in DATA_FORMAT:
+            return utils.DataStream(fname)
+        if ext == ".json":
+            with open(fname) as f:
+                _ = json.load(f)
+        else:
+            _ = self._parse_data_file(fname)
+        if isinstance(_, dict):
+            _ = utils.dictdot(_)
+        return _
+
+    def _parse_data_file(self, fname):
+        """
+        Parse a YAML or TOML data file.
+        The result is cached, and used again as long as the file mtime and size,
+        or else its hash, didn't change.
+        """
+        stat = os.stat(fname)
+        key = "datafile:%s" % os.path.abspath(fname)
+        cached = self.cache.get(key) if self.cache else None
+        if cached and cached["mtime"] == stat.st_mtime and cached["size"] == stat.st_size:
+            return cached["data"]
+
+        h = utils.hash_file(fname)
+        if cached and cached["hash"] == h:
+            data = cached["data"]
+        else:
+            with open(fname) as f:
+                if fname.endswith(".toml"):
+                    data = utils.load_toml(f)
+                else:
+                    data = utils.load_yaml(f)
+        if self.cache:
+            self.cache.set(key, {
+                "mtime": stat.st_mtime,
+                "size": stat.st_size,
+                "hash": h,
+                "data": data
+            })
+        return data
+
+    def _load_data_api(self, name, url):
+        """
+        Doing API call to retrieve the data and assign it to its key
+        Data must be JSON. Only the url of the data accessed is fetched
+        """
+        if name not in self._data_api:
+            self._data_api[name] = self._fetch_data_api(name, url)
+        body, error = self._data_api[name]
+        if error:
+            raise Exception("Data API URLS Error: %s" % error)
+        _ = json.loads(body)
+        if isinstance(_, dict):
+            _ = utils.dictdot(_)
+        return _
+
+    def _fetch_data_api(self, name, url):
+        """
+        Fetch a data api url over the pooled session
+        :return: tuple(body, error) - the error of this url, if it failed
+        """
+        try:
+            return self._fetch_data_api_url(self._get_data_api_session(), name, url), None
+        except Exception as e:
+            return None, "%s" % e
+
+    def _get_data_api_session(self):
+        """ The session the data api urls are fetched with, sharing its connections """
+        if self._data_api_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=10)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._data_api_session = session
+        return self._data_api_session
+
+    def prefetch_data_api(self):
+        """
+        Fetch all the data api urls not fetched yet, concurrently. ie: before
+        the pages are rendered across processes, which get the responses
+        instead of fetching them each. The error of a url is only raised by
+        the pages using its data.
+        :return: dict of name -> tuple(body, error)
+        """
+        data_api_urls = dict.get(self.site_config, "data_api_urls") or {}
+        urls = [(name, url) for name, url in data_api_urls.items()
+                if name not in self._data_api]
+        if urls:
+            self._get_data_api_session()
+
+            def fetch(item):
+                return item[0], self._fetch_data_api(*item)
+
+            pool = multiprocessing.pool.ThreadPool(min(len(urls), 10))
+            try:
+                for name, result in pool.imap_unordered(fetch, urls):
+                    self._data_api[name] = result
+            finally:
+                pool.close()
+                pool.join()
+        return self._data_api
+
+    def _fetch_data_api_url(self, session, name, url):
+        """
+        Return the body of a data api url.
+        Responses are cached, and used as is for `data_api_cache_ttl` seconds.
+        After that they are revalidated with their ETag and Last-Modified.
+        With `data_api_offline`, only the cached responses are used.
+        """
+        offline = self.config.get("data_api_offline", False)
+        ttl = float(self.config.get("data_api_cache_ttl") or 0)
+        timeout = float(self.config.get("data_api_timeout") or 10)
+        key = "url:%s" % url
+        now = time.time()
+
+        cached = self.http_cache.get(key) if self.http_cache else None
+        if cached and (offline or now - cached["fetched_at"] < ttl):
+            return cached["body"]
+        if offline:
+            raise Exception("`%s -> %s` is not cached, it can't be used offline" % (name, url))
+
+        headers = {}
+        if cached and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached and cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+        r = session.get(url, headers=headers, timeout=timeout)
+        if r.status_code == 304 and cached:
+            body = cached["body"]
+        elif r.status_code == 200:
+            body = r.text
+        else:
+            raise Exception("`%s -> %s` returns status code %s" % (name, url, r.status_code))
+
+        if self.http_cache:
+            self.http_cache.set(key, {
+                "etag": r.headers.get("ETag") or (cached or {}).get("etag"),
+                "last_modified": r.headers.get("Last-Modified") or (cached or {}).get("last_modified"),
+                "fetched_at": now,
+                "body": body
+            })
+        return body
 
     def _init_webassets(self):
 
@@ -264,136 +594,586 @@ class Yass(object):
             log.setLevel(logging.DEBUG)
             self.webassets_cmd = CommandLineEnvironment(assets_env, log)
 
-    def clean_build_dir(self):
+    def clean_build_dir(self, keep_static=False):
+        """
+        :param keep_static: bool - Keep the static files and their manifest,
+                            they are synced with the static dir when building
+        """
         if os.path.isdir(self.build_dir):
-            shutil.rmtree(self.build_dir)
-        os.makedirs(self.build_dir)
+            if keep_static:
+                for name in os.listdir(self.build_dir):
+                    if name in ["static", STATIC_MANIFEST_FILE,
+                                COMPRESS_MANIFEST_FILE]:
+                        continue
+                    path = os.path.join(self.build_dir, name)
+                    if os.path.isdir(path) and not os.path.islink(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+            else:
+                shutil.rmtree(self.build_dir)
+        if not os.path.isdir(self.build_dir):
+            os.makedirs(self.build_dir)
 
-    def build_static(self):
-        """ Build static files """
-        if not os.path.isdir(self.build_static_dir):
-            os.makedirs(self.build_static_dir)
-        copy_tree(self.static_dir, self.build_static_dir)
+    def build_static(self, paths=None):
+        """
+        Build static files.
+        The files are synced with the build dir: the size, mtime and hash of
+        each file are kept in a manifest, so only the files that changed are
+        copied (or linked, see `static_sync` config), and the files deleted
+        are removed.
+        With `static_fingerprint`, each file also gets a copy with its content
+        hash in the name, ie: css/style.<hash>.css, which can be cached forever.
+        See the `yass_static_url` filter.
+        :param paths: list of the static files changed, to only check them
+        """
         if self.webassets_cmd:
             self.webassets_cmd.build()
+        if not os.path.isdir(self.build_static_dir):
+            os.makedirs(self.build_static_dir)
 
-    def build_pages(self):
-        """Iterate over the pages_dir and build the pages """
+        manifest = self._load_static_manifest()
+        if paths is None:
+            files = []
+            for root, _, _files in os.walk(self.static_dir):
+                files += [os.path.relpath(os.path.join(root, f), self.static_dir)
+                          for f in _files]
+            deleted = set(manifest) - set(files)
+        else:
+            paths = [os.path.relpath(os.path.abspath(p), os.path.abspath(self.static_dir))
+                     for p in paths]
+            files = [p for p in paths if os.path.isfile(os.path.join(self.static_dir, p))]
+            deleted = set(paths) - set(files)
+
+        mode = self.config.get("static_sync", "copy")
+        fingerprint = self.config.get("static_fingerprint") is True
+        for f in files:
+            src_file = os.path.join(self.static_dir, f)
+            dest_file = os.path.join(self.build_static_dir, f)
+            stat = os.stat(src_file)
+            # [size, mtime, hash, fingerprinted file]
+            entry = manifest.get(f)
+            exists = os.path.isfile(dest_file)
+            fp_file = entry[3] if entry else None
+            if entry and exists and entry[:2] == [stat.st_size, stat.st_mtime] \
+                    and bool(fp_file) == fingerprint \
+                    and (not fp_file or os.path.isfile(os.path.join(self.build_static_dir, fp_file))):
+                continue
+            h = utils.hash_file(src_file)
+            if not (entry and exists and entry[2] == h):
+                utils.copy_file(src_file, dest_file, mode)
+            new_fp_file = utils.fingerprint_name(f, h) if fingerprint else None
+            if fp_file and fp_file != new_fp_file:
+                self._remove_build_file(os.path.join("static", fp_file))
+            if new_fp_file and not os.path.isfile(os.path.join(self.build_static_dir, new_fp_file)):
+                utils.copy_file(src_file, os.path.join(self.build_static_dir, new_fp_file), mode)
+            manifest[f] = [stat.st_size, stat.st_mtime, h, new_fp_file]
+
+        for f in deleted:
+            entry = manifest.pop(f, None)
+            self._remove_build_file(os.path.join("static", f))
+            if entry and entry[3]:
+                self._remove_build_file(os.path.join("static", entry[3]))
+        self._save_static_manifest(manifest)
+
+        assets_manifest = os.path.join(self.build_static_dir, ASSETS_MANIFEST_FILE)
+        if fingerprint:
+            assets = dict([(f, e[3]) for f, e in manifest.items() if e[3]])
+            with open(assets_manifest, "w") as fw:
+                json.dump(assets, fw, indent=2, sort_keys=True)
+        elif os.path.isfile(assets_manifest):
+            os.remove(assets_manifest)
+
+    def _load_static_manifest(self):
+        """ Return the manifest of the static files synced by the last build """
+        if self._static_manifest is None:
+            self._static_manifest = {}
+            filepath = os.path.join(self.build_dir, STATIC_MANIFEST_FILE)
+            if os.path.isfile(filepath):
+                try:
+                    with open(filepath) as f:
+                        self._static_manifest = json.load(f)
+                except ValueError:
+                    pass
+            for entry in self._static_manifest.values():
+                entry.extend([None] * (4 - len(entry)))
+        return self._static_manifest
+
+    def _save_static_manifest(self, manifest):
+        self._static_manifest = manifest
+        with open(os.path.join(self.build_dir, STATIC_MANIFEST_FILE), "w") as f:
+            json.dump(manifest, f)
+
+    def _static_url(self, path):
+        """
+        Get the url of a static file. With `static_fingerprint`, the url of
+        its copy with the content hash in the name.
+        In the template: {{ 'css/style.css' | yass_static_url }}
+        With webassets: {{ ASSET_URL | yass_static_url }}
+        :param path: the file, relative to the static dir, or its static url
+        :return: string
+        """
+        static_url = self.config.get("static_url", "/static").rstrip("/")
+        path = path.split("?")[0]
+        if path.startswith(static_url + "/"):
+            path = path[len(static_url) + 1:]
+        path = path.lstrip("/")
+        if self._page_deps is not None:
+            self._page_deps.add("static:%s" % path)
+        if self.config.get("static_fingerprint") is True:
+            entry = self._load_static_manifest().get(path)
+            if entry and entry[3]:
+                path = entry[3]
+        return static_url + "/" + path
+
+    def _get_page_files(self):
+        """ Iterate over the pages_dir and yield the pages, relative to pages_dir """
         for root, _, files in os.walk(self.pages_dir):
             base_dir = root.replace(self.pages_dir, "").lstrip("/")
             if not base_dir.startswith("_"):
                 for f in files:
-                    src_file = os.path.join(base_dir, f)
-                    self._build_page(src_file)
+                    if self._is_page_file(f):
+                        yield os.path.join(base_dir, f)
 
-    def _build_page(self, filepath):
-        """ To build from filepath, relative to pages_dir """
+    @staticmethod
+    def _is_page_file(filepath):
+        """ If filename starts with _ (underscore) or . (dot) do not build """
         filename = filepath.split("/")[-1]
-        # If filename starts with _ (underscore) or . (dot) do not build
-        if not filename.startswith(("_", ".")) and (filename.endswith(PAGE_FORMAT)):
-            meta = self._get_page_meta(filepath)
-            content = self._get_page_content(filepath)
-
-            # The default context for the page
-            _default_page = {
-                "build_dir": self.build_dir,
-                "filepath": meta["filepath"],
-                "context": {"page": meta},
-                "content": content,
-                "markup": meta.get("markup"),
-                "template": meta.get("template"),
-                "layout": meta.get("layout") or self.default_layout
-            }
-
-            # GENERATOR
-            # Allows to generate
-            _generator = meta.get("_generator")
-            if _generator:
-                data = self._data.get(_generator.get("data_source"))
-
-                # We want these back in meta in they exists in the data
-                special_meta = ["title", "slug", "description"]
-
-                # SINGLE
-                if _generator.get("type") == "single":
-                    for d in data:
-                        dmeta = copy.deepcopy(meta)
-                        page = copy.deepcopy(_default_page)
-                        for _ in special_meta:
-                            if _ in d:
-                                dmeta[_] = d.get(_)
-
-                        # If generator has the slug, it will substitute if
-                        # Slug in the generator must have token from the data
-                        # to generate the slug
-                        if "slug" in _generator:
-                            dmeta["slug"] = _generator.get("slug").format(**d)
-
-                        # Slug is required
-                        if "slug" not in dmeta:
-                            print("WARNING: Skipping page because it's missing `slug`")
-                            continue
-                        slug = dmeta.get("slug")
-                        dmeta["url"] = slug
-                        dmeta["context"] = d
-
-                        page.update({
-                            "filepath": slug,
-                            "context": {"page": dmeta}
-                        })
-                        self.create_page(**page)
-
-                if _generator.get("type") == "pagination":
-
-                    per_page = int(_generator.get("per_page", self.site_config.get("pagination.per_page", 10)))
-                    left_edge = int(_generator.get("left_edge", self.site_config.get("pagination.left_edge", 2)))
-                    left_current = int(_generator.get("left_edge", self.site_config.get("pagination.left_current", 3)))
-                    right_current = int(_generator.get("right_current", self.site_config.get("pagination.right_current", 4)))
-                    right_edge = int(_generator.get("right_edge", self.site_config.get("pagination.right_edge", 2)))
-                    padding = _generator.get("padding")
-                    slug = _generator.get("slug")
-                    limit = _generator.get("limit")
+        return not filename.startswith(("_", ".")) \
+               and filename.endswith(PAGE_FORMAT)
+
+    def build_pages(self, incremental=False, jobs=None):
+        """
+        Iterate over the pages_dir and build the pages
+        :param incremental: bool - If True, only the pages whose sources,
+                            templates, data or config changed since the last
+                            build will be rendered again
+        :param jobs: int - The number of processes to render the pages with.
+                     Default to the `workers` config, 1 to build serially
+        """
+        jobs = int(jobs or self.config.get("workers") or 1)
+        self._dep_hashes = {}
+        self._template_refs = {}
+        self.scan_pages()
+
+        graph = self._load_build_graph()
+        old_sources = graph.get("sources", {})
+        old_inputs = graph.get("inputs", {})
+        if graph.get("config") != self._get_config_signature() \
+                or not os.path.isfile(self.site_index_file):
+            incremental = False
+
+        sources = {}
+        pages = []
+        for src_file in self._get_page_files():
+            record = old_sources.get(src_file)
+            if incremental and record \
+                    and not self._is_stale(record, old_inputs):
+                sources[src_file] = record
+            else:
+                pages.append(src_file)
+
+        if jobs > 1 and len(pages) > 1:
+            sources.update(self._build_pages_parallel(pages, jobs))
+        else:
+            for src_file in pages:
+                record = self._build_page(src_file)
+                if record:
+                    sources[src_file] = record
+
+        # Remove the outputs of deleted pages, or those no longer generated
+        outputs = set([o for r in sources.values() for o in r["outputs"]])
+        for r in old_sources.values():
+            for o in r["outputs"]:
+                if o not in outputs:
+                    self._remove_build_file(o)
+
+        inputs = {}
+        for r in sources.values():
+            for dep in r["deps"]:
+                if dep not in inputs:
+                    inputs[dep] = self._get_dep_hash(dep)
+
+        # The minify stats are only reported, not kept in the build graph
+        stats = dict([(p, sources[p].pop("minify")) for p in pages
+                      if "minify" in sources.get(p, {})])
+        if self.html_minify:
+            self.minify_report = self._get_minify_report(stats)
+
+        self._save_site_index(sources)
+        self._save_build_graph({
+            "version": BUILD_GRAPH_VERSION,
+            "config": self._get_config_signature(),
+            "inputs": inputs,
+            "sources": sources,
+            "site_files": self._build_site_files(graph.get("site_files", {}))
+        })
+
+    def _save_site_index(self, sources):
+        """
+        Write the index of the pages, for the sitemap and the feed: a line of
+        [page, entries] per page source, sorted by page. The entries of the
+        pages built are taken off their record, those of the pages skipped
+        are read from the index of the last build.
+        :param sources: dict of the build record of each page
+        """
+        old_index = self._iter_site_index()
+        old_page, old_entries = next(old_index, (None, None))
+        if not os.path.isdir(self.build_dir):
+            os.makedirs(self.build_dir)
+        tmp_file = self.site_index_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            for page in sorted(sources):
+                entries = sources[page].pop("index", None)
+                if entries is None:
+                    while old_page is not None and old_page < page:
+                        old_page, old_entries = next(old_index, (None, None))
+                    entries = old_entries if old_page == page else []
+                f.write(json.dumps([page, entries]) + "\n")
+        os.rename(tmp_file, self.site_index_file)
+
+    def _iter_site_index(self):
+        """ Iterate over the [page, entries] of the index of the pages """
+        if os.path.isfile(self.site_index_file):
+            with open(self.site_index_file) as f:
+                for line in f:
+                    yield json.loads(line)
+
+    def _iter_site_entries(self):
+        """ Iterate over the entries of the index of the pages, page by page """
+        for _, entries in self._iter_site_index():
+            for e in entries:
+                yield e
+
+    def _build_site_files(self, hashes):
+        """
+        Write the sitemap, the feed and robots.txt, from the index of the pages
+        built: `make_sitemap`, `make_rss` and `make_robots`.
+        The entries are read from the index and streamed to the files, each
+        file being hashed as it's written. Above 50,000 urls, the sitemap is
+        split into sitemap-N.xml files, listed in sitemap.xml. A file is only
+        replaced when its content changed since the last build.
+        :param hashes: dict of the hash of each file written by the last build
+        :return: dict of the hash of each file written
+        """
+        site_url = (self.site_config.get("url") or
+                    "http://%s" % (self.sitename or "")).rstrip("/")
+        written = {}
+
+        def write(filename, writer, *args):
+            f = utils.HashedFile(self.build_dir)
+            writer(f, site_url, *args)
+            save(filename, f)
+
+        def save(filename, f):
+            written[filename] = f.save(os.path.join(self.build_dir, filename),
+                                       hashes.get(filename))
+
+        if self.config.get("make_sitemap") is True:
+            # Each shard is written as the urls are read. The first one is
+            # sitemap.xml, unless there are more
+            urls = (e for e in self._iter_site_entries() if e[4])
+            shards = []
+            while True:
+                shard = list(itertools.islice(urls, SITEMAP_MAX_URLS))
+                if shards and not shard:
+                    break
+                f = utils.HashedFile(self.build_dir)
+                self._write_sitemap(f, site_url, shard)
+                if len(shards) == 1:
+                    save("sitemap-1.xml", shards[0])
+                if shards:
+                    save("sitemap-%s.xml" % (len(shards) + 1), f)
+                shards.append(f)
+                if len(shard) < SITEMAP_MAX_URLS:
+                    break
+            if len(shards) == 1:
+                save("sitemap.xml", shards[0])
+            else:
+                names = ["sitemap-%s.xml" % (i + 1) for i in range(len(shards))]
+                write("sitemap.xml", self._write_sitemap_index, names)
+
+        if self.config.get("make_rss") is True:
+            items = heapq.nlargest(int(self.config.get("rss_limit") or 20),
+                                   (e for e in self._iter_site_entries() if e[1]),
+                                   key=lambda e: e[1])
+            channel = [self.site_config.get("name") or self.sitename,
+                       self.site_config.get("description")]
+            write("feed.xml", self._write_feed, channel, items)
+
+        if self.config.get("make_robots") is True:
+            sitemap = "sitemap.xml" in written
+            write("robots.txt", self._write_robots, sitemap)
+
+        for filename in set(hashes) - set(written):
+            self._remove_build_file(filename)
+        return written
+
+    @staticmethod
+    def _write_sitemap(f, site_url, entries):
+        """ Write the urlset of a sitemap """
+        f.write(u'<?xml version="1.0" encoding="UTF-8"?>\n'
+                u'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+        url = None
+        for e in entries:
+            if e[0] == url:
+                continue
+            url = e[0]
+            f.write(u"<url><loc>%s</loc>" % escape(site_url + url))
+            if e[1]:
+                f.write(u"<lastmod>%s</lastmod>" % e[1])
+            f.write(u"</url>\n")
+        f.write(u"</urlset>\n")
+
+    @staticmethod
+    def _write_sitemap_index(f, site_url, names):
+        """ Write the index of the sitemap files """
+        f.write(u'<?xml version="1.0" encoding="UTF-8"?>\n'
+                u'<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+        for name in names:
+            f.write(u"<sitemap><loc>%s/%s</loc></sitemap>\n" % (escape(site_url), name))
+        f.write(u"</sitemapindex>\n")
+
+    @staticmethod
+    def _write_feed(f, site_url, channel, items):
+        """ Write the RSS feed of the pages with a date, the latest first """
+        title, description = channel
+        f.write(u'<?xml version="1.0" encoding="UTF-8"?>\n'
+                u'<rss version="2.0"><channel>\n'
+                u"<title>%s</title><link>%s/</link><description>%s</description>\n"
+                % (escape(u"%s" % (title or "")), escape(site_url),
+                   escape(u"%s" % (description or ""))))
+        for url, date, title, description, _ in items:
+            link = escape(site_url + url)
+            f.write(u"<item><title>%s</title><link>%s</link><guid>%s</guid>"
+                    u"<pubDate>%s</pubDate>"
+                    % (escape(u"%s" % (title or "")), link, link,
+                       arrow.get(date).to("utc").format("ddd, DD MMM YYYY HH:mm:ss +0000")))
+            if description:
+                f.write(u"<description>%s</description>" % escape(u"%s" % description))
+            f.write(u"</item>\n")
+        f.write(u"</channel></rss>\n")
+
+    @staticmethod
+    def _write_robots(f, site_url, sitemap):
+        """ Write robots.txt, allowing everything """
+        f.write(u"User-agent: *\nDisallow:\n")
+        if sitemap:
+            f.write(u"Sitemap: %s/sitemap.xml\n" % site_url)
+
+    @staticmethod
+    def _get_minify_report(stats):
+        """
+        The size and the time it took to minify the files of the pages built
+        :param stats: dict of page -> list of [output, size, minified size, seconds]
+        :return: dict of the number of `pages` and of output `files`, their
+                 `size` and `minified_size`, the `time` to minify them, and
+                 the `slowest` files to minify: list of tuple(output, seconds)
+        """
+        files = [f for outputs in stats.values() for f in outputs]
+        return {
+            "pages": len(stats),
+            "files": len(files),
+            "size": sum([f[1] for f in files]),
+            "minified_size": sum([f[2] for f in files]),
+            "time": sum([f[3] for f in files]),
+            "slowest": [(f[0], f[3]) for f in
+                        heapq.nlargest(5, files, key=lambda f: f[3])]
+        }
 
+    def _build_pages_parallel(self, pages, jobs):
+        """
+        Build the pages across a pool of processes.
+        Every worker gets the meta of all the pages from the scan, so they all
+        resolve the links to other pages the same way. Each page is sent along
+        with its record, so the workers don't read the sources again. The data
+        api urls are fetched once, and their responses sent to the workers.
+        :param pages: list of pages, relative to pages_dir
+        :param jobs: int - the number of processes
+        :return: dict of the build record of each page
+        """
+        sources = {}
+        chunksize = max(1, len(pages) // (jobs * 4))
+        pool = multiprocessing.Pool(jobs,
+                                    initializer=_init_worker,
+                                    initargs=(self.root_dir,
+                                              self._init_config,
+                                              self._pages_meta,
+                                              self.prefetch_data_api()))
+        try:
+            tasks = [(p, self._pages[p]) for p in pages]
+            for src_file, record in pool.imap_unordered(_build_page_worker,
+                                                        tasks,
+                                                        chunksize):
+                if record:
+                    sources[src_file] = record
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return sources
+
+    def _build_page(self, filepath, only=None):
+        """
+        To build from filepath, relative to pages_dir
+        :param only: the file to write, relative to the build dir. The other
+                     files of a generator are skipped, see render_url()
+        :return: dict of the `outputs` created, and the `deps` used to render
+                 them. None if the file is not a page
+        """
+        if self._is_page_file(filepath):
+            self._page_deps = set(["page:%s" % filepath, "site:meta"])
+            self._page_outputs = []
+            self._page_index = []
+            self._page_minify = []
+            self._page_only = only
+            self._data.track()
+            self.site_config.track()
+            try:
+                self._render_page(filepath)
+                self._page_deps.update(["data:%s" % k for k in self._data.untrack()])
+                self._page_deps.update(["site:%s" % k for k in self.site_config.untrack()])
+                record = {
+                    "outputs": sorted(set(self._page_outputs)),
+                    "deps": sorted(self._page_deps),
+                    "index": self._page_index
+                }
+                # [output, size, minified size, seconds] of each of its outputs
+                if self.html_minify:
+                    record["minify"] = self._page_minify
+                return record
+            finally:
+                self._data.untrack()
+                self.site_config.untrack()
+                self._page_deps = None
+                self._page_outputs = None
+                self._page_index = None
+                self._page_minify = None
+                self._page_only = None
+                self._page_templates = {}
+        return None
+
+    def _render_page(self, filepath):
+        """ Render the page and its generated pages, if any """
+        meta = self._get_page_meta(filepath)
+        content = self._get_page_content(filepath)
+
+        # The default context for the page
+        _default_page = {
+            "build_dir": self.build_dir,
+            "filepath": meta["filepath"],
+            "context": {"page": meta},
+            "content": content,
+            "markup": meta.get("markup"),
+            "template": meta.get("template"),
+            "layout": meta.get("layout") or self.default_layout
+        }
+
+        # GENERATOR
+        # Allows to generate
+        _generator = meta.get("_generator")
+        if _generator:
+            data_source = _generator.get("data_source")
+            # `stream` reads a JSON array file item by item instead of loading it
+            if _generator.get("stream") and self._data_sources.get(data_source):
+                data = utils.DataStream(self._data_sources[data_source])
+                if self._page_deps is not None:
+                    self._page_deps.add("data:%s" % data_source)
+            else:
+                data = self._data.get(data_source)
+
+            # All the generated pages share the same template, compiled once.
+            # Each page gets a shallow copy of the meta, with only its own keys
+            # set on it. The nested values of the meta are shared, not copied.
+            tpl, toc = self._compile_page(content=content,
+                                          template=_default_page["template"],
+                                          markup=_default_page["markup"],
+                                          layout=_default_page["layout"])
+
+            # We want these back in meta in they exists in the data
+            special_meta = ["title", "slug", "description"]
+
+            # SINGLE
+            if _generator.get("type") == "single":
+                for d in data:
+                    dmeta = dict(meta)
+                    for _ in special_meta:
+                        if _ in d:
+                            dmeta[_] = d.get(_)
+
+                    # If generator has the slug, it will substitute if
+                    # Slug in the generator must have token from the data
+                    # to generate the slug
+                    if "slug" in _generator:
+                        dmeta["slug"] = _generator.get("slug").format(**d)
+
+                    # Slug is required
+                    if "slug" not in dmeta:
+                        print("WARNING: Skipping page because it's missing `slug`")
+                        continue
+                    slug = dmeta.get("slug")
+                    dmeta["url"] = slug
+                    dmeta["context"] = d
+                    self._write_page(self.build_dir, slug, tpl, {"page": dmeta}, toc)
+
+            if _generator.get("type") == "pagination":
+
+                per_page = int(_generator.get("per_page", self.site_config.get("pagination.per_page", 10)))
+                left_edge = int(_generator.get("left_edge", self.site_config.get("pagination.left_edge", 2)))
+                left_current = int(_generator.get("left_edge", self.site_config.get("pagination.left_current", 3)))
+                right_current = int(_generator.get("right_current", self.site_config.get("pagination.right_current", 4)))
+                right_edge = int(_generator.get("right_edge", self.site_config.get("pagination.right_edge", 2)))
+                padding = _generator.get("padding")
+                slug = _generator.get("slug")
+                limit = _generator.get("limit")
+
+                # Streamed data is chunked on the fly, after counting the items
+                if isinstance(data, utils.DataStream):
+                    len_data = data.count()
+                    if "limit" in _generator:
+                        len_data = min(len_data, int(limit))
+                        data = itertools.islice(data, int(limit))
+                    data_chunks = utils.chunk_iter(data, per_page)
+                else:
                     if "limit" in _generator:
                         data = data[:int(limit)]
                     data_chunks = utils.chunk_list(data, per_page)
                     len_data = len(data)
 
-                    for i, d in enumerate(data_chunks):
-                        dmeta = copy.deepcopy(meta)
-                        page = copy.deepcopy(_default_page)
-
-                        page_num = i + 1
-                        _paginator = Paginator([],
-                                               total=len_data,
-                                               page=page_num,
-                                               per_page=per_page,
-                                               padding=padding,
-                                               left_edge=left_edge,
-                                               right_edge=right_edge,
-                                               left_current=left_current,
-                                               right_current=right_current)
-                        _paginator.slug = slug
-                        _paginator.index_slug = _generator.get("index_slug")
-
-                        _slug = slug.format(**{"page_num": page_num})
-                        dmeta["url"] = _slug
-                        dmeta["context"] = d
-                        dmeta["paginator"] = _paginator
-                        page.update({
-                            "filepath": _slug,
-                            "context": {"page": dmeta}
-                        })
-                        self.create_page(**page)
-
-                        # First page need to generate the index
-                        if i == 0 and _generator.get("index_slug"):
-                            page["filepath"] = _generator.get("index_slug")
-                            self.create_page(**page)
-
-            # NORMAL PAGE
-            else:
-                self.create_page(**_default_page)
+                for i, d in enumerate(data_chunks):
+                    dmeta = dict(meta)
+
+                    page_num = i + 1
+                    _paginator = Paginator([],
+                                           total=len_data,
+                                           page=page_num,
+                                           per_page=per_page,
+                                           padding=padding,
+                                           left_edge=left_edge,
+                                           right_edge=right_edge,
+                                           left_current=left_current,
+                                           right_current=right_current)
+                    _paginator.slug = slug
+                    _paginator.index_slug = _generator.get("index_slug")
+
+                    _slug = slug.format(**{"page_num": page_num})
+                    dmeta["url"] = _slug
+                    dmeta["context"] = d
+                    dmeta["paginator"] = _paginator
+                    context = {"page": dmeta}
+                    self._write_page(self.build_dir, _slug, tpl, context, toc)
+
+                    # First page need to generate the index
+                    if i == 0 and _generator.get("index_slug"):
+                        self._write_page(self.build_dir,
+                                         _generator.get("index_slug"),
+                                         tpl, context, toc)
+
+        # NORMAL PAGE
+        else:
+            self.create_page(**_default_page)
 
     def create_page(self, build_dir, filepath, context={}, content=None, template=None, markup=None, layout=None):
         """
@@ -423,34 +1203,30 @@ class Yass(object):
                         file can be in html|jade|md
         :return:
         """
+        tpl, toc = self._compile_page(content=content,
+                                      template=template,
+                                      markup=markup,
+                                      layout=layout)
+        self._write_page(build_dir, filepath, tpl, context, toc)
 
-        build_dir = build_dir.rstrip("/")
-        filepath = filepath.lstrip("/").rstrip("/")
-        if not filepath.endswith(".html"):
-            filepath += "/index.html"
-        dest_file = os.path.join(build_dir, filepath)
-        dest_dir = os.path.dirname(dest_file)
-
-        if not os.path.isdir(dest_dir):
-            os.makedirs(dest_dir)
-
-        _context = context
-        if "page" not in _context:
-            _context["page"] = self.default_page_meta.copy()
-        if "url" not in _context["page"]:
-            _context["page"]["url"] = "/" + filepath.lstrip("/").replace(
-                "index.html", "")
-
+    def _compile_page(self, content=None, template=None, markup=None, layout=None):
+        """
+        Return the compiled template of a page, see create_page() for the params
+        :return: tuple(Template, toc) - toc is the Table of Content of markdown
+        """
+        toc = None
         if template:
             if template not in self._templates:
                 self._templates[template] = self.tpl_env.get_template(template)
             tpl = self._templates[template]
+            if self._page_deps is not None:
+                self._page_deps.update(["template:%s" % t for t in
+                                        self._get_template_refs(template)])
         else:
             if markup == "md":
-                _context["page"]["__toc__"] = md.get_toc(content)
-                content = md.convert(content)
+                content, toc = md.convert_with_toc(content, cache=self.cache)
             elif markup == "jade":
-                content = jade.convert(content)
+                content = jade.convert(content, cache=self.cache)
 
             # Page must be extended by a layout and have a block 'body'
             # These tags will be included if they are missing
@@ -465,25 +1241,578 @@ class Yass(object):
                 content = "\n" + _layout_block + "\n" + \
                           "{% block body %} \n" + content.strip() + "\n{% endblock %}"
 
-            tpl = self.tpl_env.from_string(content)
+            tpl, refs = self._get_page_template(content)
+            if self._page_deps is not None:
+                for ref in refs:
+                    self._page_deps.update(["template:%s" % t for t in
+                                            self._get_template_refs(ref)])
+        return tpl, toc
+
+    def _write_page(self, build_dir, filepath, tpl, context={}, toc=None):
+        """
+        Render a compiled page and save it in the build_dir
+        see create_page() for the params
+        """
+        build_dir = build_dir.rstrip("/")
+        filepath = filepath.lstrip("/").rstrip("/")
+        if not filepath.endswith(".html"):
+            filepath += "/index.html"
+        if self._page_only and filepath != self._page_only:
+            return
+        dest_file = os.path.join(build_dir, filepath)
+        dest_dir = os.path.dirname(dest_file)
+
+        if not os.path.isdir(dest_dir):
+            os.makedirs(dest_dir)
+
+        _context = context
+        if "page" not in _context:
+            _context["page"] = self.default_page_meta.copy()
+        if "url" not in _context["page"]:
+            _context["page"]["url"] = "/" + filepath.lstrip("/").replace(
+                "index.html", "")
+        if toc is not None:
+            _context["page"]["__toc__"] = toc
+
+        html = tpl.render(**_context)
+        if self.html_minify:
+            start = time.time()
+            size = len(html.encode("utf-8"))
+            html = htmlmin.minify(html)
+            if self._page_minify is not None:
+                self._page_minify.append([os.path.relpath(dest_file, self.build_dir),
+                                          size, len(html.encode("utf-8")),
+                                          time.time() - start])
 
         with open(dest_file, "w") as fw:
-            fw.write(tpl.render(**_context))
+            fw.write(html)
+
+        if self._page_outputs is not None:
+            output = os.path.relpath(dest_file, self.build_dir)
+            self._page_outputs.append(output)
+            self._page_index.append(self._get_index_entry(output, _context["page"]))
+
+    def _get_index_entry(self, output, page):
+        """
+        The entry of a page in the index of the site, for the sitemap and the
+        feed. The date is the `date` of the page, or of its generator data
+        :param output: the file of the page, relative to the build_dir
+        :param page: the page meta
+        :return: list [url, date, title, description, in sitemap]
+        """
+        context = page.get("context")
+        date = page.get("date") \
+            or (context.get("date") if isinstance(context, dict) else None)
+        if date:
+            try:
+                date = arrow.get(date).isoformat()
+            except (ValueError, TypeError, RuntimeError):
+                date = None
+        return ["/" + output.replace("index.html", ""),
+                date,
+                page.get("title"),
+                page.get("description"),
+                page.get("sitemap") is not False]
+
+    def _get_page_template(self, content):
+        """
+        Return the compiled template of a page content, along with the templates
+        it references. The same content (ie: generated pages) is compiled once,
+        and the compiled code is kept in the bytecode cache across builds.
+        :param content: the page content, with its layout and block body
+        :return: tuple(Template, list)
+        """
+        key = utils.hash_content(content)
+        if key not in self._page_templates:
+            env = self.tpl_env
+            bcc = env.bytecode_cache
+            bucket = None
+            refs = None
+            if bcc and self.cache:
+                bucket = bcc.get_bucket(env, "__page__%s" % key, None, content)
+                if bucket.code is not None:
+                    refs = self.cache.get("refs:%s" % key)
+            if refs is None:
+                ast = env.parse(content)
+                refs = [r for r in jinja2.meta.find_referenced_templates(ast) if r]
+                code = env.compile(ast)
+                if bucket:
+                    bucket.code = code
+                    bcc.set_bucket(bucket)
+                    self.cache.set("refs:%s" % key, refs)
+            else:
+                code = bucket.code
+            tpl = env.template_class.from_code(env, code, env.globals, None)
+            self._page_templates[key] = (tpl, refs)
+        return self._page_templates[key]
 
-    def build(self):
-        self.clean_build_dir()
+    def _get_template_refs(self, name):
+        """
+        Return the template name along with all the templates it extends,
+        includes or imports, recursively. The templates a source references
+        are cached by its hash, so unchanged templates are not parsed again
+        :param name: the template name, relative to `/templates/`
+        :return: set
+        """
+        if name not in self._template_refs:
+            self._template_refs[name] = set([name])
+            refs = set([name])
+            try:
+                source, filename, _ = self.tpl_env.loader.get_source(self.tpl_env, name)
+                # The extension is part of the key, jade templates are converted
+                key = "refs:%s%s" % (utils.hash_content(source),
+                                     os.path.splitext(name)[1])
+                direct_refs = self.cache.get(key) if self.cache else None
+                if direct_refs is None:
+                    ast = self.tpl_env.parse(source, name, filename)
+                    direct_refs = [r for r in jinja2.meta.find_referenced_templates(ast) if r]
+                    if self.cache:
+                        self.cache.set(key, direct_refs)
+                for ref in direct_refs:
+                    refs.update(self._get_template_refs(ref))
+            except jinja2.TemplateNotFound:
+                pass
+            self._template_refs[name] = refs
+        return self._template_refs[name]
+
+    def _get_dep_hash(self, dep):
+        """
+        Return the content hash of a dependency
+        :param dep: string - type:name, ie: page:index.md, template:layouts/default.jade
+                    meta:about.md, data:posts, site:name, static:css/style.css
+        :return: string, None if it doesn't exist
+        """
+        if dep not in self._dep_hashes:
+            kind, name = dep.split(":", 1)
+            h = None
+            if kind == "page":
+                if name in self._pages:
+                    h = self._pages[name].hash
+                else:
+                    h = utils.hash_file(os.path.join(self.pages_dir, name))
+            elif kind == "meta":
+                if name in self._pages_meta:
+                    h = self._get_meta_hash(self._pages_meta[name])
+            elif kind == "section":
+                h = utils.hash_content(json.dumps(
+                    [p for p in sorted(self._pages_meta)
+                     if not self._pages_meta[p].get("_generator")
+                     and (not name or p.startswith(name + "/"))]))
+            elif kind == "template":
+                try:
+                    source, _, _ = self.tpl_env.loader.get_source(self.tpl_env, name)
+                    h = utils.hash_content(source)
+                except jinja2.TemplateNotFound:
+                    pass
+            elif kind == "data":
+                if self._data_sources.get(name):
+                    h = utils.hash_file(self._data_sources[name])
+                elif name in self._data:
+                    h = utils.hash_content(json.dumps(self._data[name],
+                                                      sort_keys=True, default=str))
+            elif kind == "static":
+                h = utils.hash_file(os.path.join(self.static_dir, name))
+            elif kind == "site":
+                h = utils.hash_content(json.dumps(dict.get(self.site_config, name),
+                                                  sort_keys=True, default=str))
+            self._dep_hashes[dep] = h
+        return self._dep_hashes[dep]
+
+    def _get_meta_hash(self, meta):
+        """ The hash of a page meta, without the toc added when it's rendered """
+        meta = dict([(k, v) for k, v in meta.items() if k != "__toc__"])
+        return utils.hash_content(json.dumps(meta, sort_keys=True, default=str))
+
+    def _get_config_signature(self):
+        """
+        The hash of the config affecting every page. When it changes, the
+        whole site must be rebuilt. `site` keys are tracked per page, and the
+        data of the api urls with their `data:` deps.
+        """
+        conf = dict([(k, v) for k, v in self.config.items()
+                     if k not in ["site", "hosting", "local_server"] + RUNTIME_CONFIG])
+        conf["__version__"] = __version__
+        return utils.hash_content(json.dumps(conf, sort_keys=True, default=str))
+
+    def _is_stale(self, record, inputs):
+        """
+        Check if a page from the build graph must be built again
+        :param record: dict - the page `outputs` and `deps`
+        :param inputs: dict - the hash of each dep at the last build
+        :return: bool
+        """
+        for o in record["outputs"]:
+            if not os.path.isfile(os.path.join(self.build_dir, o)):
+                return True
+        for dep in record["deps"]:
+            if self._get_dep_hash(dep) != inputs.get(dep):
+                return True
+        return False
+
+    def _load_build_graph(self):
+        """ Return the build graph saved by the last build """
+        if os.path.isfile(self.build_graph_file):
+            try:
+                with open(self.build_graph_file) as f:
+                    graph = json.load(f)
+                if graph.get("version") == BUILD_GRAPH_VERSION:
+                    return graph
+            except ValueError:
+                pass
+        return {}
+
+    def _save_build_graph(self, graph):
+        if not os.path.isdir(self.build_dir):
+            os.makedirs(self.build_dir)
+        with open(self.build_graph_file, "w") as f:
+            json.dump(graph, f)
+
+    def _remove_build_file(self, filepath):
+        """
+        Remove a file from the build dir, along with its empty directories
+        :param filepath: the file path, relative to the build_dir
+        """
+        dest_file = os.path.join(self.build_dir, filepath)
+        if os.path.isfile(dest_file):
+            os.remove(dest_file)
+        dest_dir = os.path.dirname(dest_file)
+        while dest_dir != self.build_dir and os.path.isdir(dest_dir) \
+                and not os.listdir(dest_dir):
+            os.rmdir(dest_dir)
+            dest_dir = os.path.dirname(dest_dir)
+
+    def build(self, incremental=False, jobs=None):
+        """
+        Build everything
+        :param incremental: bool - If True, the build dir is kept and only the
+                            pages that changed since the last build are rendered
+        :param jobs: int - The number of processes to render the pages with
+        """
+        if not incremental or not os.path.isfile(self.build_graph_file):
+            incremental = False
+            self.clean_build_dir(keep_static=True)
         if not os.path.isdir(self.build_dir):
             os.makedirs(self.build_dir)
         self.build_static()
-        self.build_pages()
+        self.build_pages(incremental=incremental, jobs=jobs)
+        self.compress_build()
+
+    def compress_build(self):
+        """
+        Write the compressed copies of the text files of the build, for each
+        `precompress` encoding: gzip (index.html.gz) and br (index.html.br).
+        The files are compressed in parallel, and only the files that changed
+        since the last build, from their size, mtime and hash.
+        The copies of the files removed are removed.
+        """
+        encodings = self.config.get("precompress") or []
+        if not isinstance(encodings, list):
+            encodings = [encodings]
+        manifest_file = os.path.join(self.build_dir, COMPRESS_MANIFEST_FILE)
+        manifest = {}
+        if os.path.isfile(manifest_file):
+            try:
+                with open(manifest_file) as f:
+                    manifest = json.load(f)
+            except ValueError:
+                pass
+        if not encodings and not manifest:
+            return
+
+        variants = tuple(utils.COMPRESS_EXTENSIONS.values())
+        files = []
+        for root, _, _files in os.walk(self.build_dir):
+            for f in _files:
+                if not f.startswith(".yass-") and not f.endswith(variants) \
+                        and utils.is_compressible(f):
+                    files.append(os.path.relpath(os.path.join(root, f), self.build_dir))
+
+        def remove_variants(f, keep=[]):
+            for encoding, ext in utils.COMPRESS_EXTENSIONS.items():
+                if encoding not in keep:
+                    self._remove_build_file(f + ext)
+
+        for f in set(manifest) - set(files):
+            remove_variants(f)
+            del manifest[f]
+
+        # [size, mtime, hash, encodings]
+        tasks = []
+        for f in files:
+            filepath = os.path.join(self.build_dir, f)
+            stat = os.stat(filepath)
+            entry = manifest.get(f)
+            if entry and entry[:2] == [stat.st_size, stat.st_mtime] \
+                    and entry[3] == encodings \
+                    and all([os.path.isfile(filepath + utils.COMPRESS_EXTENSIONS[e])
+                             for e in encodings]):
+                continue
+            tasks.append((f, entry, stat))
+
+        def compress(task):
+            f, entry, stat = task
+            filepath = os.path.join(self.build_dir, f)
+            h = utils.hash_file(filepath)
+            remove_variants(f, keep=encodings)
+            for encoding in encodings:
+                dest_file = filepath + utils.COMPRESS_EXTENSIONS[encoding]
+                if not (entry and entry[2] == h and os.path.isfile(dest_file)):
+                    utils.compress_file(filepath, dest_file, encoding)
+            return f, [stat.st_size, stat.st_mtime, h, encodings]
+
+        if tasks:
+            # zlib releases the GIL, so the files are compressed in threads
+            pool = multiprocessing.pool.ThreadPool(multiprocessing.cpu_count())
+            try:
+                for f, entry in pool.imap_unordered(compress, tasks):
+                    manifest[f] = entry
+            finally:
+                pool.close()
+                pool.join()
+
+        if encodings:
+            with open(manifest_file, "w") as f:
+                json.dump(manifest, f)
+        elif os.path.isfile(manifest_file):
+            os.remove(manifest_file)
+
+    def rebuild(self, paths):
+        """
+        Rebuild only what is affected by the files that changed, ie: when
+        serving. A page rebuilds its own outputs, and those of the pages linking
+        to it if its meta changed. A template or a data file rebuilds the pages
+        using it. A static file builds the static files again.
+        Falls back to an incremental build when there's no build graph yet.
+        :param paths: list of the files changed, added or deleted
+        :return: list of the pages built
+        """
+        graph = self._load_build_graph()
+        if not graph or graph.get("config") != self._get_config_signature() \
+                or not os.path.isfile(self.site_index_file):
+            self.build(incremental=True)
+            return list(self._get_page_files())
+
+        if not self._pages:
+            self.scan_pages()
+        old_sources = graph.get("sources", {})
+        old_inputs = graph.get("inputs", {})
+        changed, pages, deleted, static = self._get_changes(paths, graph)
+        if static:
+            self.build_static(static)
+
+        sources = dict([(k, v) for k, v in old_sources.items()
+                        if k not in deleted])
+        for src_file in sorted(pages):
+            record = self._build_page(src_file)
+            if record:
+                record.pop("minify", None)
+                sources[src_file] = record
+            else:
+                sources.pop(src_file, None)
+
+        outputs = set([o for r in sources.values() for o in r["outputs"]])
+        for r in old_sources.values():
+            for o in r["outputs"]:
+                if o not in outputs:
+                    self._remove_build_file(o)
+
+        # Only the deps that changed, or those of the pages built, are hashed
+        fresh = changed.union([d for p in pages if p in sources
+                               for d in sources[p]["deps"]])
+        inputs = {}
+        for r in sources.values():
+            for dep in r["deps"]:
+                if dep not in inputs:
+                    if dep in fresh or dep not in old_inputs:
+                        inputs[dep] = self._get_dep_hash(dep)
+                    else:
+                        inputs[dep] = old_inputs[dep]
+
+        self._save_site_index(sources)
+        graph.update(inputs=inputs, sources=sources,
+                     site_files=self._build_site_files(graph.get("site_files", {})))
+        self._save_build_graph(graph)
+        return sorted(pages)
 
-    def publish(self, target="S3", sitename=None, purge_files=True):
+    def _get_changes(self, paths, graph):
+        """
+        Map the files changed, added or deleted to the deps of the build graph.
+        The pages changed are scanned again, and the data files reloaded.
+        :param paths: list of the files
+        :param graph: dict - the build graph, with the `sources` and `inputs`
+        :return: tuple(set of the deps changed, set of the pages to build,
+                       set of the pages deleted, list of the static files)
+        """
+        old_sources = graph.get("sources", {})
+        old_inputs = graph.get("inputs", {})
+        changed = set()
+        pages = set()
+        deleted = set()
+        static = []
+        for path in paths:
+            path = os.path.abspath(path)
+            exists = os.path.isfile(path)
+            if self._is_in_dir(path, self.pages_dir):
+                page = os.path.relpath(path, self.pages_dir)
+                if page.startswith("_") or not self._is_page_file(page):
+                    continue
+                self._pages_meta.pop(page, None)
+                if page in self._pages:
+                    self._pages_urls.pop(self._pages.pop(page).meta["url"], None)
+                changed.add("page:%s" % page)
+                if exists:
+                    pages.add(page)
+                    meta = self._scan_page(page).meta
+                    if page in old_sources and self._get_meta_hash(meta) \
+                            == old_inputs.get("meta:%s" % page):
+                        continue
+                else:
+                    deleted.add(page)
+                changed.add("meta:%s" % page)
+                if page not in old_sources or not exists:
+                    section = page.split("/")[:-1]
+                    changed.update(["section:%s" % "/".join(section[:i])
+                                    for i in range(len(section) + 1)])
+            elif self._is_in_dir(path, self.templates_dir):
+                changed.add("template:%s" % os.path.relpath(path, self.templates_dir))
+                self._templates = {}
+            elif self._is_in_dir(path, self.data_dir):
+                name, ext = os.path.splitext(os.path.basename(path))
+                if ext in DATA_FORMAT or ext in utils.DataStream.FORMATS:
+                    changed.add("data:%s" % name)
+                    if exists:
+                        self._data.set_loader(name, functools.partial(self._load_data_file, path))
+                        self._data_sources[name] = path
+                    else:
+                        self._data.unset(name)
+                        self._data_sources.pop(name, None)
+            elif self._is_in_dir(path, self.static_dir):
+                changed.add("static:%s" % os.path.relpath(path, self.static_dir))
+                static.append(path)
+
+        self._dep_hashes = {}
+        self._template_refs = {}
+        for src_file, record in old_sources.items():
+            if changed.intersection(record["deps"]):
+                pages.add(src_file)
+        pages.difference_update(deleted)
+        return changed, pages, deleted, static
+
+    @staticmethod
+    def _is_in_dir(path, directory):
+        """ If the path is inside the directory """
+        return os.path.abspath(path).startswith(os.path.abspath(directory) + os.sep)
+
+    def render_url(self, url):
+        """
+        Render the page of a url on request, ie: when serving without building
+        the site first. The url is mapped back to its page source, or to the
+        generator whose slug matches it, of which only the file of the url is
+        rendered. The pages rendered are kept in the build dir until a file
+        they depend on changes, see invalidate().
+        :param url: the url path, ie: /blog/
+        :return: the file to serve from the build dir, None if there's none
+        """
+        if not self._pages:
+            self.scan_pages()
+        filepath = url.split("?")[0].strip("/")
+        dest_file = os.path.join(self.build_dir, filepath)
+        if self._is_in_dir(dest_file, self.build_static_dir):
+            return dest_file if os.path.isfile(dest_file) else None
+        if not filepath.endswith(".html"):
+            filepath = os.path.join(filepath, "index.html")
+
+        if filepath not in self._lazy_outputs:
+            for page in self._get_url_pages(filepath):
+                self._render_lazy(page, filepath)
+                if filepath in self._lazy_outputs:
+                    break
+        if filepath in self._lazy_outputs:
+            return os.path.join(self.build_dir, filepath)
+        return None
+
+    def _get_url_pages(self, filepath):
+        """
+        Return the pages that may build a file: the page with the same url
+        first, then the generators whose slug matches it, and the single
+        generators without a slug, whose items may have the url as `slug`
+        :param filepath: the file, relative to the build dir
+        :return: list
+        """
+        page = self._pages_urls.get("/" + filepath.replace("index.html", ""))
+        pages = []
+        if page and not self._pages_meta[page].get("_generator"):
+            pages.append(page)
+        for page, meta in sorted(self._pages_meta.items()):
+            _generator = meta.get("_generator")
+            if _generator:
+                slugs = [_generator.get(k) for k in ["slug", "index_slug"]
+                         if _generator.get(k)]
+                if not slugs and _generator.get("type") == "single":
+                    pages.append(page)
+                elif [s for s in slugs if self._match_slug(s, filepath)]:
+                    pages.append(page)
+        return pages
+
+    @staticmethod
+    def _match_slug(slug, filepath):
+        """
+        If a file may be built from a generator slug, ie: /blog/{id}
+        :param slug: the slug, with its format fields
+        :param filepath: the file, relative to the build dir
+        :return: bool
+        """
+        slug = slug.strip("/")
+        if not slug.endswith(".html"):
+            slug += "/index.html"
+        regex = "".join([re.escape(text) + (".+?" if field is not None else "")
+                         for text, field, _, _ in string.Formatter().parse(slug)])
+        return re.match(regex + "$", filepath) is not None
+
+    def _render_lazy(self, page, filepath):
+        """
+        Render the file of a page on request, and keep its outputs and deps.
+        The files of a generator are added to its record one by one
+        """
+        record = self._build_page(page, only=filepath)
+        if record:
+            rendered = self._lazy_graph["sources"].get(page)
+            if rendered:
+                record["outputs"] = sorted(set(rendered["outputs"] + record["outputs"]))
+                record["deps"] = sorted(set(rendered["deps"] + record["deps"]))
+            self._lazy_graph["sources"][page] = record
+            for dep in record["deps"]:
+                self._lazy_graph["inputs"][dep] = self._get_dep_hash(dep)
+            self._lazy_outputs.update(record["outputs"])
+
+    def invalidate(self, paths):
+        """
+        Drop the pages rendered on request that are affected by the files
+        changed, so they are rendered again on the next request
+        :param paths: list of the files changed, added or deleted
+        :return: list of the pages dropped
+        """
+        changed, pages, deleted, static = self._get_changes(paths, self._lazy_graph)
+        if static:
+            self.build_static(static)
+        dropped = []
+        for page in pages.union(deleted):
+            record = self._lazy_graph["sources"].pop(page, None)
+            if record:
+                self._lazy_outputs.difference_update(record["outputs"])
+                dropped.append(page)
+        return sorted(dropped)
+
+    def publish(self, target="S3", sitename=None, purge_files=True,
+                rebuild_manifest=False):
         """
         To publish programatically
 
         :param target: Where to pusblish at, S3
         :param sitename: The site name
-        :param purge_files: if True, it will delete old files
+        :param purge_files: if True, it will delete the files removed from the site
+        :param rebuild_manifest: if True, the manifest is rebuilt from the
+                                 files of the bucket. It is when it's missing
         :return:
         """
         self.build()
@@ -493,7 +1822,14 @@ class Yass(object):
             p = publisher.S3Website(sitename=sitename or self.config.get("sitename"),
                                     aws_access_key_id=endpoint.get("aws_access_key_id"),
                                     aws_secret_access_key=endpoint.get("aws_secret_access_key"),
-                                    region=endpoint.get("aws_region"))
+                                    region=endpoint.get("aws_region"),
+                                    endpoint_url=endpoint.get("endpoint_url"),
+                                    upload_workers=endpoint.get("upload_workers", 10),
+                                    upload_retries=endpoint.get("upload_retries", 3),
+                                    multipart_threshold=endpoint.get("multipart_threshold", 16),
+                                    multipart_chunksize=endpoint.get("multipart_chunksize", 8),
+                                    gzip=endpoint.get("gzip", False),
+                                    cache_rules=endpoint.get("cache_rules"))
             if not p.website_exists:
                 if p.create_website() is True:
                     # Need to give it enough time to create it
@@ -501,12 +1837,15 @@ class Yass(object):
                     time.sleep(10)
                     p.create_www_website()
 
-            p.create_manifest_from_s3_files()
-
-            if purge_files:
-                exclude_files = endpoint.get("purge_exclude_files", [])
-                p.purge_files(exclude_files=exclude_files)
+            if rebuild_manifest or not p.manifest_exists():
+                p.create_manifest_from_s3_files()
 
-            p.upload(self.build_dir)
+            result = p.upload(self.build_dir,
+                              purge=purge_files,
+                              exclude_files=endpoint.get("purge_exclude_files", []))
+            failed = result["failed"]
+            if failed:
+                raise Exception("%s file(s) failed to upload: %s"
+                                % (len(failed), ", ".join([f for f, _ in failed])))
             return p.website_endpoint_url
 